@@ -1,9 +1,19 @@
+import os
+import sys
+import pickle
+import threading
+import subprocess
 import requests
 import json
+import numpy as np
 from datetime import datetime as dt
-from datetime import timedelta
+from datetime import timedelta, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from project.data.preprocessor import Preprocessor
+from project.data.storage import atomic_dump
 
 date_format = '%Y-%m-%dT%H:%M:%SZ'
 
@@ -23,6 +33,42 @@ location_id = {
     'florida_uib': 'SN50539'
 }
 
+# Frost elements of the measurements of the weather stations
+ELEMENTS = {
+    'temp (C)': 'air_temperature',
+    'precipitation (mm)': 'sum(precipitation_amount PT1H)'
+}
+
+location_measurements = {  # Same measurements as the raw files
+    'florida_sentrum': ['temp (C)', 'precipitation (mm)'],
+    'florida_uib': ['precipitation (mm)']
+}
+
+# Max number of concurrent requests (and pooled connections)
+MAX_WORKERS = 8
+
+# Data directories, fetched data is written as raw files and ingested like them
+data_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+raw_data_path = os.path.join(data_path, 'raw_data')
+
+def make_session(pool_size: int= MAX_WORKERS, retries: int= 5, backoff: float= 0.5) -> requests.Session:
+    """
+    Session keeping up to pool_size connections alive per host, retrying
+    failed GETs (connection errors, 429 and 5xx) with exponential backoff
+    """
+    retry = Retry(
+        total= retries, backoff_factor= backoff, status_forcelist= [429, 500, 502, 503, 504],
+        allowed_methods= ['GET'], raise_on_status= False
+    )
+    adapter = HTTPAdapter(pool_connections= 2, pool_maxsize= pool_size, max_retries= retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Shared by all requests, so connections are reused
+session = make_session()
+
 def to_datetime(*strings):
     return tuple([
         dt.strptime(s, date_format)
@@ -30,127 +76,220 @@ def to_datetime(*strings):
     ])
     
 def get_dates_between(first, last):
-    for x in range((last - first).seconds // 3600):
+    for x in range(int((last - first).total_seconds()) // 3600):
         yield first + timedelta(hours= x)
         
 def check_response(r):
     if r.status_code != 200:
         raise IOError(f'Unsuccesful api request. Status: {r.status_code}, {r.reason}')
 
-def get_weather_forecast():
-    # Retrive response from endpoint
-    r = requests.get(
-        url= met_url,
-        headers= { 'User-Agent': sitename }
-    )
-    
-    check_response(r)
-    
-    expiration = r.headers['Expires']
-    last_modified = r.headers['Last-Modified']
-    data = json.loads(r.content)
-
-    # Extract data
-    timeseries = data['properties']['timeseries']
-    
-    # Further extract relevant data from each timeseries object
+def expand_forecast(timeseries: list) -> list:
+    """
+    Hourly datapoints of the forecast timeseries. Gaps (the timeseries
+    gets 6-hourly further ahead) are filled with the temperature of the
+    last point, and its precipitation for the period spread evenly.
+    """
+    datapoints = []
     last = timeseries[0]
     for dp in timeseries[1:]:
 
         # Need datapoints for all hours - might be gap in timeseries
         # If so, use last dp from timeseries
-        dates_between = get_dates_between(*to_datetime(last['time'], dp['time']))
-        dates_between = list(dates_between)
+        dates_between = list(get_dates_between(*to_datetime(last['time'], dp['time'])))
+        period = last['data'].get('next_1_hours', last['data'].get('next_6_hours'))
+        precipitation = period['details']['precipitation_amount'] if period else 0
         for d in dates_between:
-            yield {
+            datapoints.append({
                 'date': d,
                 'temp (C)': last['data']['instant']['details']['air_temperature'],
-                'precipitation (mm)': last['data'].get(
-                    'last_1_hours',
-                    last['data'].get(
-                        'last_6_hours',
-                        {'details': {'precipitation': 0}}
-                    )
-                )['details']['precipitation'] / len(dates_between)
-            }
-            
+                'precipitation (mm)': precipitation / len(dates_between)
+            })
+
         last = dp
-        
-def get_historical_weather(location, _from: dt= None, _to: dt= None):
-    
-    r = requests.get(
-        url= frost_url,
+    return datapoints
+
+class ForecastCache(object):
+    """
+    Keeps the hourly forecast (see expand_forecast) in memory and on disk,
+    and only asks the api again when it has expired (the Expires header).
+    Then the request is conditional (If-Modified-Since), and if the
+    forecast has not changed, the expanded one is kept.
+
+    Args:
+        path: file to keep the forecast in between processes, None for memory only
+    """
+    def __init__(self, path: os.path= None):
+        self.path = path
+        self.datapoints = None
+        self.expires = None  # aware datetime
+        self.last_modified = None  # Last-Modified header as received
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.datapoints, self.expires, self.last_modified = pickle.load(f)
+
+    def is_fresh(self) -> bool:
+        return self.datapoints is not None and self.expires is not None \
+            and dt.now(timezone.utc) < self.expires
+
+    def get(self, url= met_url) -> list:
+        """The hourly forecast datapoints, shared by all callers, so don't modify them"""
+        with self.lock:
+            if self.is_fresh(): return self.datapoints
+
+            headers = {'User-Agent': sitename}
+            if self.datapoints is not None and self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+            r = session.get(url= url, headers= headers)
+
+            if r.status_code != 304:
+                check_response(r)
+                self.datapoints = expand_forecast(json.loads(r.content)['properties']['timeseries'])
+                self.last_modified = r.headers.get('Last-Modified')
+            self.expires = self.__expires(r)
+
+            if self.path:
+                atomic_dump((self.datapoints, self.expires, self.last_modified), self.path)
+            return self.datapoints
+
+    @staticmethod
+    def __expires(r):
+        try:
+            return parsedate_to_datetime(r.headers['Expires'])
+        except (KeyError, TypeError, ValueError):
+            return None  # Ask again next time
+
+# The forecast of the app
+forecast_cache = ForecastCache(os.path.join(data_path, 'forecast_cache.pickle'))
+
+def get_weather_forecast(url= met_url) -> list:
+    """Hourly forecast datapoints, fetched only when the last has expired, see ForecastCache"""
+    return forecast_cache.get(url)
+
+def date_chunks(first: dt, last: dt, chunk: timedelta):
+    """Consecutive (start, end) intervals of at most chunk covering first to last"""
+    while first < last:
+        yield first, min(first + chunk, last)
+        first += chunk
+
+def clean_observations(data: list, location) -> list:
+    """
+    Datapoints of the Frost observation data of location, sorted by date,
+    same as the cleaners in raw_reader give for the raw files (dates in
+    norsk normaltid, missing values nan)
+    """
+    values = {}  # date -> element -> value
+    for item in data:
+        date = dt.strptime(item['referenceTime'][:19], '%Y-%m-%dT%H:%M:%S') + timedelta(hours= 1)
+        for obs in item['observations']:
+            values.setdefault(date, {}).setdefault(obs['elementId'], obs['value'])
+
+    return [
+        dict(date= date, **{
+            meas: float(elements.get(ELEMENTS[meas], np.nan))
+            for meas in location_measurements[location]
+        })
+        for date, elements in sorted(values.items())
+    ]
+
+def get_observations(location, start: dt, end: dt, url= frost_url) -> list:
+    """Frost observation data of location from start (utc) to end (exclusive)"""
+    r = session.get(
+        url= url,
         params= {
             'sources': location_id[location],
-            'elements': 'air_temperature,sum(precipitation_amount PT1H)',
-            'referencetime': '2020-04-01/2020-04-03',
+            'elements': ','.join(ELEMENTS[meas] for meas in location_measurements[location]),
+            'referencetime': f'{start.strftime(date_format)}/{end.strftime(date_format)}',
         },
         auth= (client_id, '')
     )
-    
+
+    if r.status_code == 404: return []  # No data in the interval
     check_response(r)
-    
-    data = r.json()['data']
-    
-    return data
 
-class api_reader(object):
+    return r.json()['data']
+
+def get_historical_weather(location, _from: dt, _to: dt, chunk= timedelta(days= 30),
+                           workers: int= 4, url= frost_url) -> list:
     """
-    Class that lets the preprocessor class treat this as a reading object.
-    This way, when api calls are made, they can be easily pickled and saved in
-    the existing datastructue.
+    Datapoints of the weather station location from _from to _to (exclusive),
+    both in norsk normaltid like the datapoints.
+
+    The range is fetched in intervals of chunk, by up to workers
+    (at most MAX_WORKERS) concurrent requests over the shared session.
+    Failed requests are retried, see make_session.
     """
-    
-    def read(self, reader, cleaner, location):
-        """
-        Method required by preprocessor.
-        
-        Args:
-            location, cleaner: not used.
-            reader: specify an api callback to use.
-        """
-        return reader()
-        
-def update_weather_stations(from_date, to_date):    
+    normaltid = timedelta(hours= 1)
+    chunks = list(date_chunks(_from - normaltid, _to - normaltid, chunk))
+
+    with ThreadPoolExecutor(max_workers= max(1, min(workers, MAX_WORKERS))) as executor:
+        data = executor.map(lambda c: get_observations(location, *c, url= url), chunks)
+        # In order, so the datapoints are sorted
+        return clean_observations([item for items in data for item in items], location)
+
+station_name = {
+    'florida_sentrum': 'Bergen - Florida',
+    'florida_uib': 'Bergen - Florida Uib'
+}
+
+csv_columns = {  # Columns of the raw files downloaded from seklima.met.no
+    'temp (C)': 'Lufttemperatur',
+    'precipitation (mm)': 'Nedbør (1 t)'
+}
+
+def write_raw_file(datapoints: list, location, path: os.path):
+    """
+    Writes datapoints of location to path in the format of the raw files
+    of the station, so they are parsed like them
+    """
+    def value(v):
+        return '-' if np.isnan(v) else str(v).replace('.', ',')
+
+    measurements = location_measurements[location]
+    lines = [';'.join(['Navn', 'Stasjon', 'Tid(norsk normaltid)'] + [csv_columns[m] for m in measurements])]
+    lines += [
+        ';'.join(
+            [station_name[location], location_id[location], dp['date'].strftime('%d.%m.%Y %H:%M')]
+            + [value(dp[m]) for m in measurements]
+        )
+        for dp in datapoints
+    ]
+    os.makedirs(os.path.dirname(path), exist_ok= True)
+    with open(path, 'w', encoding= 'utf-8-sig') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def update_weather_stations(from_date: dt, to_date: dt, raw_path: os.path= raw_data_path,
+                            ingest= True, **kwargs) -> list:
     """
     Updates the pickled datastructures with data between
     the specified dates fetched from 'https://frost.met.no/observations'
-    """
-    
-    def get_florida_uib():
-        return get_historical_weather('florida_uib', from_date, to_date)
-    
-    def get_florida_sentrum():
-        return get_historical_weather('florida_sentrum', from_date, to_date)
-    
-    processors = {
-        'florida_sentrum': {
-            'reader': get_florida_sentrum,
-            'cleaner': None
-        },
-        'florida_uib': {
-            'reader': get_florida_uib,
-            'cleaner': None
-        }
-    }
-    
-    reader = api_reader()
-    pp = Preprocessor(reader=reader, processors= processors)
-    
-    pp.transform()
-    
-data = list(get_weather_forecast())
 
-r = requests.get(
-    url= 'https://frost.met.no/sources/v0.jsonld',
-    params= {
-        'municipality': 'BERGEN'
-    },
-    auth= (client_id, '')
-)
+    The data of each station is written as a raw file under
+    raw_path/<station>/ (fetching the same range again replaces it), and
+    ingested with the preprocessor, which only places the new files.
+    The range should not overlap the raw files already there.
 
-data = r.json()
+    Args:
+        ingest: run the preprocessor, else only write the raw files
+        kwargs: passed to get_historical_weather (chunk, workers, url)
 
-hist_weath = get_historical_weather()
+    Returns the paths of the raw files written.
+    """
+    paths = []
+    for location in location_id:
+        datapoints = get_historical_weather(location, from_date, to_date, **kwargs)
+        if not datapoints: continue
+        path = os.path.join(
+            raw_path, location, f'frost_{from_date:%d.%m.%y}-{to_date:%d.%m.%y}.csv'
+        )
+        write_raw_file(datapoints, location, path)
+        paths.append(path)
 
-print(len(hist_weath))
\ No newline at end of file
+    if ingest and paths:
+        # The preprocessor is a script (run from the root git repo, see README)
+        subprocess.run(
+            [sys.executable, os.path.join(data_path, 'preprocessor.py'), '--raw', raw_path],
+            cwd= os.path.dirname(os.path.dirname(data_path)), check= True
+        )
+    return paths
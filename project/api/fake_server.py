@@ -0,0 +1,238 @@
+import json
+import math
+import time
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+date_format = '%Y-%m-%dT%H:%M:%SZ'
+
+def observation(source: str, element: str, time: datetime):
+    """
+    Deterministic value of element at source at the (utc) hour time,
+    None if the station has no observation then. The fake server serves
+    these, so fetched data can be checked against them.
+    """
+    hour = int(time.timestamp() // 3600)
+    offset = sum(map(ord, source)) % 7
+    if element == 'air_temperature':
+        return round(
+            8 + offset / 10 + 6 * math.sin(2 * math.pi * hour / 24)
+            + 4 * math.sin(2 * math.pi * hour / 8766), 1
+        )
+    if element == 'sum(precipitation_amount PT1H)':
+        x = (hour * 2654435761 + offset) % 1000
+        if x % 37 == 0: return None
+        return 0. if x < 600 else round((x - 600) / 100, 1)
+    return None
+
+class FakeMETHandler(BaseHTTPRequestHandler):
+    """Serves the Frost observations and the MET locationforecast endpoints used by project.api"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            n = server.requests
+            server.paths[urlparse(self.path).path] += 1
+        if server.latency: time.sleep(server.latency)
+
+        # Fail every fail_every-th request, like an overloaded server
+        if server.fail_every and n % server.fail_every == 0:
+            return self.send_json(503, {'error': {'reason': 'Service unavailable'}})
+
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == '/observations/v0.jsonld':
+            self.observations(params)
+        elif url.path == '/weatherapi/locationforecast/2.0/compact':
+            self.forecast()
+        else:
+            self.send_json(404, {'error': {'reason': 'Not found'}})
+
+    def observations(self, params: dict):
+        first, last = [
+            datetime.strptime(s, date_format) for s in params['referencetime'].split('/')
+        ]
+        elements = params['elements'].split(',')
+        data = []
+        for source in params['sources'].split(','):
+            t = first
+            while t < last:
+                observations = [
+                    {'elementId': e, 'value': v, 'unit': 'degC' if e == 'air_temperature' else 'mm',
+                     'timeOffset': 'PT0H', 'timeResolution': 'PT1H'}
+                    for e in elements for v in [observation(source, e, t)] if v is not None
+                ]
+                if observations:
+                    data.append({
+                        'sourceId': f'{source}:0',
+                        'referenceTime': t.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                        'observations': observations
+                    })
+                t += timedelta(hours= 1)
+
+        # Like Frost, no data is a 404
+        if not data:
+            return self.send_json(404, {'error': {'reason': 'No data found'}})
+        self.send_json(200, {'@type': 'ObservationResponse', 'totalItemCount': len(data), 'data': data})
+
+    def forecast(self):
+        server = self.server
+        headers = {
+            'Expires': format_datetime(datetime.now(timezone.utc) + server.expires, usegmt= True),
+            'Last-Modified': format_datetime(server.modified, usegmt= True)
+        }
+
+        since = self.headers.get('If-Modified-Since')
+        if since and parsedate_to_datetime(since) >= server.modified:
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            return self.end_headers()
+
+        # Hourly for two days, then every 6 hours, like the real forecast
+        start = server.modified.replace(tzinfo= None, minute= 0, second= 0, microsecond= 0)
+        times = [start + timedelta(hours= h) for h in range(48)]
+        times += [times[-1] + timedelta(hours= h) for h in range(6, 24 * 7, 6)]
+        timeseries = []
+        for t, next_t in zip(times, times[1:] + [None]):
+            data = {'instant': {'details': {'air_temperature': observation('forecast', 'air_temperature', t)}}}
+            if next_t is not None:
+                hours = int((next_t - t).total_seconds() // 3600)
+                period = 'next_1_hours' if hours == 1 else 'next_6_hours'
+                data[period] = {'details': {'precipitation_amount': float(hours)}}
+            timeseries.append({'time': t.strftime(date_format), 'data': data})
+
+        self.send_json(200, {'type': 'Feature', 'properties': {'timeseries': timeseries}}, headers)
+
+    def send_json(self, status: int, content: dict, headers: dict= {}):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+class FakeMETServer(ThreadingHTTPServer):
+    """
+    Local stand-in for frost.met.no and api.met.no, so fetching can be tested
+    offline. Serves in a background thread while used as a context manager:
+
+    with FakeMETServer(latency= 0.05) as server:
+        get_historical_weather('florida_uib', date1, date2, url= server.frost_url)
+
+    Args:
+        latency: seconds each response is delayed, like a remote server
+        fail_every: answer every fail_every-th request with 503 (0 never)
+        expires: how long the forecast responses say they are valid
+    """
+    daemon_threads = True
+
+    def __init__(self, latency: float= 0, fail_every: int= 0, expires= timedelta(hours= 1), port: int= 0):
+        super().__init__(('127.0.0.1', port), FakeMETHandler)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.expires = expires
+        self.modified = datetime.now(timezone.utc).replace(microsecond= 0)
+        self.requests = 0  # Number of requests received
+        self.paths = Counter()  # Number of requests of each endpoint
+        self.lock = threading.Lock()
+
+    def update_forecast(self):
+        """Issues a new forecast (a later Last-Modified)"""
+        self.modified = max(
+            datetime.now(timezone.utc).replace(microsecond= 0), self.modified + timedelta(seconds= 1)
+        )
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    @property
+    def frost_url(self) -> str:
+        return self.url + '/observations/v0.jsonld'
+
+    @property
+    def met_url(self) -> str:
+        return self.url + '/weatherapi/locationforecast/2.0/compact?lat=60.39&lon=5.32'
+
+    def __enter__(self):
+        threading.Thread(target= self.serve_forever, daemon= True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+# Check fetched data against the fake server, compare the throughput
+# of sequential and parallel fetching, and count the forecast requests
+if __name__ == '__main__':
+    import numpy as np
+    import os
+    import tempfile
+    from project.api import get_historical_weather, location_id, ELEMENTS, location_measurements
+    from project.api import ForecastCache
+
+    date1, date2 = datetime(2019, 1, 1), datetime(2020, 1, 1)
+
+    def check(datapoints, location):
+        expected_hours = int((date2 - date1).total_seconds() // 3600)
+        assert len(datapoints) <= expected_hours
+        for dp in datapoints:
+            utc = dp['date'] - timedelta(hours= 1)  # norsk normaltid
+            for meas in location_measurements[location]:
+                value = observation(location_id[location], ELEMENTS[meas], utc)
+                assert (np.isnan(dp[meas]) and value is None) or dp[meas] == value, (dp, value)
+        assert [dp['date'] for dp in datapoints] == sorted(set(dp['date'] for dp in datapoints))
+
+    for workers in [1, 8]:
+        with FakeMETServer(latency= 0.05) as server:
+            start = time.perf_counter()
+            n = 0
+            for location in location_id:
+                datapoints = get_historical_weather(
+                    location, date1, date2, chunk= timedelta(days= 14), workers= workers, url= server.frost_url
+                )
+                check(datapoints, location)
+                n += len(datapoints)
+            elapsed = time.perf_counter() - start
+            print(f'workers {workers}: {server.requests} requests, {n} datapoints in {elapsed:.2f} s '
+                  f'({n / elapsed:.0f} datapoints/s)')
+
+    # Failed requests are retried
+    with FakeMETServer(fail_every= 3) as server:
+        for location in location_id:
+            check(get_historical_weather(location, date1, date2, workers= 4, url= server.frost_url), location)
+        print(f'with failures: {server.requests} requests, data equal')
+
+    # The forecast is only downloaded again when expired and changed
+    forecast_path = '/weatherapi/locationforecast/2.0/compact'
+    with FakeMETServer(expires= timedelta(seconds= 2)) as server:
+        path = os.path.join(tempfile.mkdtemp(), 'forecast.pickle')
+        cache = ForecastCache(path)
+        first = cache.get(server.met_url)
+        assert len(first) == 47 + 6 * 27 and all(
+            b['date'] - a['date'] == timedelta(hours= 1) for a, b in zip(first, first[1:])
+        )
+        for _ in range(100):
+            assert cache.get(server.met_url) is first  # From memory
+        assert ForecastCache(path).get(server.met_url) == first  # From disk
+        assert server.paths[forecast_path] == 1, server.paths
+
+        time.sleep(2.5)
+        assert cache.get(server.met_url) is first  # Revalidated (304)
+        assert server.paths[forecast_path] == 2, server.paths
+
+        server.update_forecast()
+        time.sleep(2.5)
+        assert cache.get(server.met_url) is not first  # Downloaded again
+        assert server.paths[forecast_path] == 3, server.paths
+        print(f'forecast: 102 gets, {server.paths[forecast_path]} requests')
@@ -1,3 +1,4 @@
+import os
 import re
 import pandas as pd
 from datetime import time, datetime
@@ -9,7 +10,8 @@ import dash_html_components as html
 from dash.dependencies import Output, Input, State
 
 from project.data import reader
-from project.data.util import string_range, merge_stations, stream_to_dataframe, PUMPSTATIONS
+from project.data.util import string_range, merge_stations, stream_to_dataframe, select_columns, PUMPSTATIONS
+from project.data.cache import LRUCache
 from project.util import *
 from project.modeling import add_predictions, get_predictions
 from project.components import *
@@ -25,6 +27,15 @@ app = dash.Dash(
 
 server = app.server
 
+# Dataframes of the data queries of update_graph (see query_dataframe), so
+# changing only what is displayed of them doesn't read the data again.
+# QUERY_CACHE_MB is its budget in each worker, 0 disables it
+query_cache = LRUCache(int(os.environ.get('QUERY_CACHE_MB', 64)) * 2**20)
+
+# All measurements of the checklists, see components.datasource_tab
+PUMP_MEAS = ['quantity (l/s)', 'level (m)']
+WEATHER_MEAS = ['precipitation (mm)', 'temp (C)']
+
 app.layout = html.Div([
     
     html.H4('Bergen Vann Pumpedata'),
@@ -118,27 +129,150 @@ def hide(dropdown_selesctions):
     Input('dropdown-hours-agg', 'value'),
     Input('dropdown-days-agg', 'value'),
     Input('dropdown-months-agg', 'value'),
-    Input('dropdown-years-agg', 'value')
+    Input('dropdown-years-agg', 'value'),
+    
+    # The x range zoomed to, shown in full resolution
+    Input('graph', 'relayoutData')
 ])
 def update_graph(start_date, end_date, years, months, days, weekdays, # Used as get_data args
                  stations, pump_meas, weather_meas, treshold, window,
-                 hour_pair, hour_agg_val, days_agg_val, months_agg_val, years_agg_val):
+                 hour_pair, hour_agg_val, days_agg_val, months_agg_val, years_agg_val,
+                 relayout_data):
 
     start_date, end_date = resolve_dates(start_date, end_date)
     
-    result = sorted(
-        reader.get_data(start_date, end_date, years, months, days,
-                        weekdays= weekdays or [], how= 'stream'),
-        key= lambda x: x['date']
-    )
+    # Chosen aggregations, in the order they are applied
+    aggregations = [
+        (name, method) for name, method in [
+            ('hours', hour_agg_val), ('days', days_agg_val),
+            ('months', months_agg_val), ('years', years_agg_val)
+        ] if method != None
+    ]
+    
+    # Aggregations of the measurements as they are can be merged from the
+    # rollups of the data, instead of reading all hours. Only with the columnar
+    # backend: the median of the statistics needs all hours anyway, and from
+    # the day pickles that read costs as much as the hourly query. Not if the
+    # hours are cached already, aggregating those is faster still
+    key, _ = query_key(start_date, end_date, years, months, days, weekdays,
+                       stations, pump_meas, weather_meas, treshold, window)
+    columns = get_columns(stations, pump_meas, weather_meas)
+    view = view_key(key, columns, aggregations, hour_pair)
+    
+    # The zoom is kept only while the figure shows the same (see create_figure's
+    # uirevision), and the range zoomed to only read when zooming triggered the
+    # update: the relayoutData of an earlier zoom is stale once the view changed
+    zoomed = 'graph.relayoutData' in [t['prop_id'] for t in dash.callback_context.triggered]
+    visible = visible_range(relayout_data) if zoomed else None
+    
+    if aggregations and not treshold and not (pump_meas and 'estimated' in pump_meas) \
+            and reader.backend == 'columnar' and key not in query_cache:
+        result = query_rollups(view, columns, aggregations, start_date, end_date,
+                               years, months, days, weekdays, hour_pair)
+        if result is not None:
+            df, stats = result
+            return create_figure(df, window= visible, uirevision= repr(view)), DisplayColumns(stats)
+    
+    df, queried = query_dataframe(start_date, end_date, years, months, days, weekdays,
+                                  stations, pump_meas, weather_meas, treshold, window)
     
-    df = create_dataframe(result, stations, pump_meas,
-                          weather_meas, treshold, window)
+    # The measurements chosen are selected from the query
+    df = select_columns(df, queried, columns)
     
     df, stats = manipulate_dataframe(df, hour_pair, hour_agg_val, days_agg_val,
                                      months_agg_val, years_agg_val)
     
-    return create_figure(df), DisplayColumns(stats)
+    return create_figure(df, window= visible, uirevision= repr(view)), DisplayColumns(stats)
+
+def query_key(start_date, end_date, years, months, days, weekdays,
+              stations, pump_meas, weather_meas, treshold, window):
+    """
+    Key of the query_dataframe query in query_cache, of the arguments that
+    determine its rows and the generation of the data, so it is read again
+    after the preprocessor has written new data. Returned with the dict of
+    station -> measurements the query has.
+    """
+    estimated = bool(pump_meas and 'estimated' in pump_meas)
+    all_pump_meas = PUMP_MEAS + ['estimated'] if estimated else PUMP_MEAS
+    
+    # The stations shown depend on whether any of their measurements are chosen
+    queried = {
+        s: meas for s, meas in get_columns(stations, all_pump_meas, WEATHER_MEAS).items()
+        if s in get_columns(stations, pump_meas, weather_meas)
+    }
+    
+    key = (
+        reader.get_generation(), start_date, end_date, tuple(years or []), tuple(months or []),
+        tuple(days or []), tuple(weekdays or []), tuple(queried), estimated, treshold or None,
+        tuple(window) if treshold else None
+    )
+    return key, queried
+
+def view_key(key, columns, aggregations, hour_pair):
+    """
+    Key of what the graph shows: the key of the hourly query (see query_key)
+    with the columns (dict of station -> measurements) and how they are aggregated
+    """
+    return key + (
+        tuple((s, tuple(meas)) for s, meas in columns.items()), tuple(aggregations),
+        tuple(hour_pair) if hour_pair is not None else None
+    )
+
+def query_rollups(view, columns, aggregations, start_date, end_date,
+                  years, months, days, weekdays, hour_pair):
+    """
+    Dataframe and statistics of aggregate_from_rollups, None if the aggregations
+    can't be merged from the rollups. Cached in query_cache under the view_key.
+    """
+    result = query_cache.get(view)
+    if result is not None: return result
+    
+    result = aggregate_from_rollups(reader, columns, aggregations, start_date, end_date,
+                                    years, months, days, weekdays, hour_pair)
+    if result is not None: query_cache.put(view, result)
+    return result
+
+def query_dataframe(start_date, end_date, years, months, days, weekdays,
+                    stations, pump_meas, weather_meas, treshold, window):
+    """
+    Dataframe of all measurements of the stations shown, as made by create_dataframe,
+    and the dict of station -> measurements it has. Cached in query_cache, see query_key.
+    """
+    key, queried = query_key(start_date, end_date, years, months, days, weekdays,
+                             stations, pump_meas, weather_meas, treshold, window)
+    df = query_cache.get(key)
+    if df is not None: return df, queried
+    
+    estimated = bool(pump_meas and 'estimated' in pump_meas)
+    all_pump_meas = PUMP_MEAS + ['estimated'] if estimated else PUMP_MEAS
+    
+    query_stations, query_meas = get_projection(list(queried), all_pump_meas,
+                                                WEATHER_MEAS, treshold)
+    
+    # Chronological stream, consumed lazily by create_dataframe
+    result = reader.get_data(start_date, end_date, years, months, days,
+                             weekdays= weekdays or [], how= 'stream',
+                             stations= query_stations, measurements= query_meas)
+    
+    df = create_dataframe(result, list(queried), all_pump_meas,
+                          WEATHER_MEAS, treshold, window)
+    query_cache.put(key, df)
+    return df, queried
+
+def get_projection(stations, pump_meas, weather_meas, treshold):
+    """
+    Stations and measurements get_data must read for the graph.
+    Estimations need all data, and so does the precipitation filter: its window
+    is counted in datapoints, and a projection drops the hours where only
+    other stations or measurements have data, which shifts the window.
+    """
+    if (pump_meas and 'estimated' in pump_meas) or treshold:
+        return None, None
+    
+    query_stations = list(stations or [])
+    query_meas = (pump_meas or []) + (weather_meas or []) + ['snodybde (cm)', 'level (cm)']
+    
+    return query_stations, query_meas
 
 def create_dataframe(datapoints, stations, pump_meas,
                      weather_meas, treshold, window):
@@ -149,7 +283,10 @@ def create_dataframe(datapoints, stations, pump_meas,
     if treshold:
         datapoints = filter_wet_days(datapoints, window, treshold)
     
-    # Define data to include in dataframe
+    return stream_to_dataframe(datapoints, get_columns(stations, pump_meas, weather_meas))
+
+def get_columns(stations, pump_meas, weather_meas):
+    """Define data to include in dataframe: dict of station -> measurements"""
     stations = stations or []
     df_data = {}
     for s in stations:
@@ -161,8 +298,7 @@ def create_dataframe(datapoints, stations, pump_meas,
             df_data[s] = ['snodybde (cm)']
         elif s == 'tidevannsdata':
             df_data[s] = ['level (cm)']
-    
-    return stream_to_dataframe(datapoints, df_data)
+    return df_data
 
 def manipulate_dataframe(df, hour_pair, hour_agg_val, days_agg_val,
                          months_agg_val, years_agg_val):
@@ -178,18 +314,12 @@ def manipulate_dataframe(df, hour_pair, hour_agg_val, days_agg_val,
     # No need to filter further
     if df.empty: return df, stats
     
-    # Repeating code here, fix later
-    if hour_agg_val != None:
-        df = aggregate_hours(df, hour_agg_val)
-    
-    if days_agg_val != None:
-        df = aggregate_days(df, days_agg_val)
-    
-    if months_agg_val != None:
-        df = aggregate_months(df, months_agg_val)
-    
-    if years_agg_val != None:
-        df = aggregate_years(df, years_agg_val)
+    df = aggregate(df, [
+        (name, method) for name, method in [
+            ('hours', hour_agg_val), ('days', days_agg_val),
+            ('months', months_agg_val), ('years', years_agg_val)
+        ] if method != None
+    ])
 
     return df, stats
 
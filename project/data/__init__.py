@@ -1,3 +1,12 @@
+import os
 from project.data.reader import PickledDataReader
 
-reader = PickledDataReader()
\ No newline at end of file
+# DATA_BACKEND=columnar serves from memory mapped columnar_data, so that
+# preloaded gunicorn workers share the pages through the OS page cache.
+# DAY_CACHE_MB is the budget of the cache of decoded day files of the pickle
+# backend in each worker (see PickledDataReader), 0 disables it
+reader = PickledDataReader(
+    backend= 'columnar', mmap_mode= 'r'
+) if os.environ.get('DATA_BACKEND') == 'columnar' else PickledDataReader(
+    cache_bytes= int(os.environ.get('DAY_CACHE_MB', 32)) * 2**20
+)
@@ -0,0 +1,156 @@
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+def deep_sizeof(obj) -> int:
+    """
+    Approximate memory footprint (bytes) of obj, following the containers
+    used by the reader: dicts, lists, tuples, numpy arrays and dataframes.
+    """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index= True, deep= False).sum())
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else 0)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(x) for x in obj)
+    return size
+
+def uniform_sizeof(obj) -> int:
+    """
+    Same as deep_sizeof, but the items of each list or tuple are assumed to
+    be the size of the first, as in the day files (a list of dates or of
+    floats per measurement). Many times faster than following every item.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(uniform_sizeof(k) + uniform_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)) and obj:
+        size += len(obj) * uniform_sizeof(obj[0])
+    return size
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache bounded by the total (estimated)
+    size of its values in bytes rather than by number of entries.
+
+    Args:
+        max_bytes: byte budget. Least recently used entries are evicted
+        when it is exceeded, values larger than the budget are not stored.
+
+        sizeof: callback that estimates the size of a value in bytes.
+
+        sample_every: values put with a size hint (see put) are sized with
+        sizeof only for the first few and then one in sample_every, to
+        measure the bytes per unit of hint the others are estimated with.
+    """
+    def __init__(self, max_bytes: int, sizeof= deep_sizeof, sample_every: int= 64):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.sample_every = sample_every
+
+        # Sizes and hints of the sampled values, see estimate
+        self.hinted = 0
+        self.sampled_bytes = 0
+        self.sampled_hints = 0
+
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        # Counters, see stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+        self.put_bytes = 0
+        self.puts = 0
+
+    def get(self, key, default= None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def __contains__(self, key) -> bool:
+        """If key is cached, without counting a hit or miss or making it recently used"""
+        with self.lock:
+            return key in self.entries
+
+    def estimate(self, value, hint: int) -> int:
+        """
+        Size of value in bytes, from a cheap hint proportional to it (e.g. the
+        size of the file it was decoded from) times the bytes per unit of hint
+        measured with sizeof on a sample of the values
+        """
+        with self.lock:
+            self.hinted += 1
+            sample = self.hinted <= 16 or self.hinted % self.sample_every == 0 or not self.sampled_hints
+            if not sample: return int(hint * self.sampled_bytes / self.sampled_hints)
+
+        size = self.sizeof(value)
+        with self.lock:
+            self.sampled_bytes += size
+            self.sampled_hints += hint
+        return size
+
+    def put(self, key, value, hint: int= None):
+        """Stores value, sized with sizeof, or estimated from hint if given (see estimate)"""
+        size = self.sizeof(value) if hint is None else self.estimate(value, hint)
+        with self.lock:
+            self.put_bytes += size
+            self.puts += 1
+        if size > self.max_bytes: return
+
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last= False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def mean_size(self) -> float:
+        """Mean size of the values put so far (None before the first), to estimate what a scan needs"""
+        with self.lock:
+            return self.put_bytes / self.puts if self.puts else None
+
+    def fits(self, n: int) -> bool:
+        """
+        False if n values of mean_size would exceed the budget. Storing the
+        values of such a scan would only evict them all before they are used again.
+        """
+        size = self.mean_size()
+        return size is None or n * size <= self.max_bytes
+
+    def skip(self):
+        """Counts a value that was not stored, see fits"""
+        with self.lock:
+            self.skipped += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'skipped': self.skipped,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
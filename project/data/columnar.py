@@ -0,0 +1,402 @@
+import os
+import pickle
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+
+try:
+    from .storage import atomic_write
+except ImportError:  # Imported as a sibling by the preprocessor script
+    from storage import atomic_write
+
+DATE = 'date'
+
+# Compression of the partition members: name -> zipfile method
+ZIP_COMPRESSION = {
+    None: zipfile.ZIP_STORED,
+    'zlib': zipfile.ZIP_DEFLATED,
+    'lzma': zipfile.ZIP_LZMA
+}
+
+# Byte shuffled arrays are stored under key + SHUFFLED + their dtype
+SHUFFLED = '.shuffled.'
+
+class ColumnarStore(object):
+    """
+    Alternative storage layout to the day pickles. Every station gets one
+    file per year holding contiguous numpy arrays, one per measurement,
+    plus a sorted datetime64 index stored under the key 'date':
+
+    |-[station]
+    |     |-[year].npz
+    |     |-[year].npz
+    |     .
+
+    Args:
+        path: path to directory holding the store. If not specified
+        it will use columnar_data in the same dir as this module.
+
+        mmap_mode: if 'r', partitions are memory mapped instead of read into
+        memory, so the arrays of read_parts are views of the page cache shared
+        between processes. read copies them when it joins several years.
+
+        compression: None, 'zlib' or 'lzma'. Partitions written are compressed
+        with it. Partitions are read the same whichever they were written with,
+        but only uncompressed ones can be memory mapped.
+
+        shuffle: store the numeric arrays byte shuffled (see shuffle_array),
+        which makes them compress better.
+    """
+    def __init__(self, path: os.path= None, mmap_mode: str= None, compression: str= None,
+                 shuffle= False):
+
+        self.path = os.path.normpath(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'columnar_data')
+        ) if not path else path
+
+        self.mmap_mode = mmap_mode
+
+        if compression not in ZIP_COMPRESSION:
+            raise ValueError(f'Unknown compression {compression}')
+        self.compression = compression
+        self.shuffle = shuffle
+
+    def partition_path(self, station: str, year: int):
+        return os.path.join(self.path, station, f'{year}.npz')
+
+    def get_stations(self):
+        if not os.path.isdir(self.path): return []
+        return sorted(
+            s for s in os.listdir(self.path)
+            if os.path.isdir(os.path.join(self.path, s))
+        )
+
+    def get_years(self, station: str):
+        station_dir = os.path.join(self.path, station)
+        if not os.path.isdir(station_dir): return []
+        return sorted(
+            int(os.path.splitext(f)[0]) for f in os.listdir(station_dir)
+            if os.path.splitext(f)[1] == '.npz'
+        )
+
+    def read_partition(self, station: str, year: int, mmap_mode: str= None,
+                       measurements: list= None) -> dict:
+        """
+        Returns dict of measurement name -> array, including 'date'.
+        If measurements is specified, the other arrays are not read.
+        """
+        path = self.partition_path(station, year)
+        if mmap_mode:
+            return memmap_npz(path, mmap_mode, measurements)
+        with np.load(path) as npz:
+            columns = {}
+            for key in npz.files:
+                name = key.split(SHUFFLED)[0]
+                if measurements is None or name == DATE or name in measurements:
+                    columns[name] = unshuffle_array(key, npz[key])
+            return columns
+
+    def write_partition(self, station: str, year: int, columns: dict):
+        target = self.partition_path(station, year)
+        parent = os.path.dirname(target)
+        if not os.path.exists(parent): os.makedirs(parent)
+
+        # Written atomically, so readers (and memory maps) see the old or the
+        # new partition, never a partial one. Given the open file, numpy
+        # doesn't append .npz to the temporary name
+        def write(f):
+            if self.compression is None and not self.shuffle:
+                np.savez(f, **columns)
+            else:
+                write_npz(f, columns, self.compression, self.shuffle)
+        atomic_write(target, write)
+
+    def append(self, station: str, columns: dict, days: np.ndarray= None):
+        """
+        Adds the columns (lists or arrays, 'date' included) to the
+        partitions of station, keeping each partition sorted by date.
+
+        Args:
+            days: datetime64[D] array of days whose rows are dropped from the
+            partitions first, so the columns replace the contents of those days.
+            Partitions left empty are removed.
+        """
+        columns = to_arrays(columns) if columns else None
+        days = np.array([], dtype= 'datetime64[D]') if days is None else days
+        years = to_years(columns[DATE]) if columns else np.array([], dtype= int)
+
+        for year in np.union1d(years, to_years(days)):
+            new = {k: v[years == year] for k, v in columns.items()} if columns else None
+            path = self.partition_path(station, year)
+
+            if os.path.exists(path):
+                old = self.read_partition(station, year)
+                keep = ~np.isin(old[DATE].astype('datetime64[D]'), days)
+                old = {k: v[keep] for k, v in old.items()}
+                new = concat_columns(old, new) if new is not None else old
+
+            if new is None or not len(new[DATE]):
+                if os.path.exists(path): os.remove(path)
+                continue
+
+            self.write_partition(station, year, sort_columns(new))
+
+    def get_earliest_date(self):
+        return min((
+            self.read_partition(s, self.get_years(s)[0])[DATE][0]
+            for s in self.get_stations() if self.get_years(s)
+        ), default= None)
+
+    def get_latest_date(self):
+        return max((
+            self.read_partition(s, self.get_years(s)[-1])[DATE][-1]
+            for s in self.get_stations() if self.get_years(s)
+        ), default= None)
+
+    def read_parts(self, station: str, start: np.datetime64, end: np.datetime64,
+                   measurements: list= None):
+        """
+        Generates the columns of station with dates in the half open
+        interval [start, end), one dict of columns per year. Partitions
+        are only read when reached. Only the measurements specified are
+        read, all if None. With mmap_mode set, the columns are views of
+        the mapped partitions.
+        """
+        first, last = to_years(np.array([start, end - 1]))
+        for year in self.get_years(station):
+            if not first <= year <= last: continue
+            columns = self.read_partition(station, year, self.mmap_mode, measurements)
+            lo, hi = np.searchsorted(columns[DATE], [start, end])
+            if hi > lo:
+                yield {k: v[lo:hi] for k, v in columns.items()}
+
+    def read(self, station: str, start: np.datetime64, end: np.datetime64,
+             measurements: list= None) -> dict:
+        """
+        Same as read_parts, but returns one dict of columns, or None if
+        there are none. Several years are concatenated into new arrays.
+        """
+        parts = list(self.read_parts(station, start, end, measurements))
+        if not parts: return None
+        return parts[0] if len(parts) == 1 else concat_columns(*parts)
+
+def memmap_npz(path: os.path, mode: str= 'r', measurements: list= None) -> dict:
+    """
+    Memory maps the arrays of an uncompressed .npz file (as written by
+    np.savez), which np.load does not do for archives. Compressed and
+    byte shuffled members are read into memory instead.
+    """
+    columns = {}
+    # Everything is read and mapped through one file object, so a partition
+    # renamed into place meanwhile (see write_partition) is never mixed in
+    with open(path, 'rb') as f, zipfile.ZipFile(f) as archive:
+        for info in archive.infolist():
+            key = os.path.splitext(info.filename)[0]
+            name = key.split(SHUFFLED)[0]
+            if measurements is not None and name != DATE and name not in measurements:
+                continue
+
+            if info.compress_type != zipfile.ZIP_STORED or name != key:
+                with archive.open(info) as member:
+                    columns[name] = unshuffle_array(key, np.lib.format.read_array(member))
+                continue
+
+            # Skip the local file header to get to the .npy file
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<26xHH', f.read(30))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+
+            version = np.lib.format.read_magic(f)
+            shape, fortran_order, dtype = (
+                np.lib.format.read_array_header_1_0(f) if version == (1, 0)
+                else np.lib.format.read_array_header_2_0(f)
+            )
+            columns[key] = np.memmap(
+                f, dtype= dtype, mode= mode, offset= f.tell(),
+                shape= shape, order= 'F' if fortran_order else 'C'
+            ) if shape != (0,) else np.empty(shape, dtype)
+    return columns
+
+def write_npz(f, columns: dict, compression: str= None, shuffle= False):
+    """
+    Same as np.savez, but with the members compressed (see ZIP_COMPRESSION),
+    and the arrays byte shuffled if shuffle. np.load reads the result as usual,
+    except shuffled arrays, which read_partition and memmap_npz restore.
+    """
+    with zipfile.ZipFile(f, 'w', compression= ZIP_COMPRESSION[compression]) as archive:
+        for key, array in columns.items():
+            array = np.asanyarray(array)
+            if shuffle and array.ndim == 1 and array.dtype.itemsize > 1 and not array.dtype.hasobject:
+                key, array = f'{key}{SHUFFLED}{array.dtype.str}', shuffle_array(array)
+            with archive.open(key + '.npy', 'w', force_zip64= True) as member:
+                np.lib.format.write_array(member, array, allow_pickle= False)
+
+def shuffle_array(array: np.ndarray) -> np.ndarray:
+    """
+    The bytes of the 1d array as a (itemsize, n) uint8 array, the first
+    bytes of all items first, then the second bytes, etc. The high bytes
+    of measurements and dates barely vary, so these rows compress well.
+    """
+    return np.ascontiguousarray(array).view(np.uint8).reshape(-1, array.dtype.itemsize).T.copy()
+
+def unshuffle_array(key: str, array: np.ndarray) -> np.ndarray:
+    """Reverses shuffle_array if the array was stored shuffled (by its key)"""
+    if SHUFFLED not in key: return array
+    dtype = np.dtype(key.split(SHUFFLED)[1])
+    return np.ascontiguousarray(array.T).view(dtype).reshape(-1)
+
+def to_years(dates: np.ndarray) -> np.ndarray:
+    return dates.astype('datetime64[Y]').astype(int) + 1970
+
+def to_arrays(columns: dict) -> dict:
+    """Converts lists of values to arrays with a nanosecond date index"""
+    return {
+        # pandas converts lists of datetime objects much faster than numpy
+        k: pd.DatetimeIndex(v).to_numpy('datetime64[ns]') if k == DATE else np.asarray(v)
+        for k, v in columns.items()
+    }
+
+def sort_columns(columns: dict) -> dict:
+    order = np.argsort(columns[DATE], kind= 'stable')
+    return {k: v[order] for k, v in columns.items()}
+
+def concat_columns(*parts):
+    """Concatenates dicts of columns, filling missing measurements with nan"""
+    keys = list(dict.fromkeys(k for part in parts for k in part))
+    return {
+        k: np.concatenate([
+            part[k] if k in part else np.full(len(part[DATE]), np.nan)
+            for part in parts
+        ]) for k in keys
+    }
+
+def convert_day_pickles(source: os.path= None, target: ColumnarStore= None):
+    """
+    Converts the day pickle file structure under source
+    (default: pickled_data) to the columnar layout of target.
+    Reads the day files in date order and writes each station-year
+    partition once.
+    """
+    source = source or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'pickled_data'
+    )
+    target = target or ColumnarStore()
+
+    def sorted_dirs(path):
+        return sorted(os.listdir(path), key= lambda c: int(os.path.splitext(c)[0]))
+
+    for year in sorted_dirs(source):
+        result = {}
+        for month in sorted_dirs(os.path.join(source, year)):
+            for day in sorted_dirs(os.path.join(source, year, month)):
+                with open(os.path.join(source, year, month, day), 'rb') as f:
+                    content = pickle.load(f)
+                for station, data in content['hours'].items():
+                    station_columns = result.setdefault(station, {})
+                    for meas, vals in data.items():
+                        station_columns.setdefault(meas, []).extend(vals)
+
+        for station, columns in result.items():
+            target.write_partition(
+                station, int(year), sort_columns(to_arrays(columns))
+            )
+
+    return target
+
+
+# Convert pickled data and compare full range reads for both layouts,
+# then size on disk and cold reads of compressed copies of them
+if __name__ == "__main__":
+    import time
+    import shutil
+    import tempfile
+    from project.data.reader import PickledDataReader
+    from project.data.manifest import Manifest
+    from project.data.rollups import Rollups
+    from project.data.storage import compressed, atomic_dump
+
+    start = time.perf_counter()
+    store = convert_day_pickles()
+    Manifest.from_columnar(store).save()
+    Rollups.from_columnar(store).save()
+    print(f'conversion: {time.perf_counter() - start:.2f} s')
+
+    # The range of the converted data, so both layouts read the same days
+    date1 = PickledDataReader(backend= 'columnar').get_earliest_date()
+    date2 = PickledDataReader(backend= 'columnar').get_latest_date()
+
+    for backend, mmap_mode in [('pickle', None), ('columnar', None), ('columnar', 'r')]:
+        reader = PickledDataReader(backend= backend, mmap_mode= mmap_mode)
+        start = time.perf_counter()
+        result = reader.get_data(date1, date2, how= 'dataframe')
+        print(f'{backend} (mmap_mode={mmap_mode}): full range dataframe read '
+              f'{time.perf_counter() - start:.3f} s, '
+              f'{sum(len(df) for df in result.values())} rows')
+
+    def files(path):
+        return [os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs]
+
+    def evict(path):
+        """Drops the files from the page cache, so they are read from disk"""
+        for file in files(path):
+            fd = os.open(file, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+    def copy_pickles(target, codec):
+        source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pickled_data')
+        for file in files(source):
+            with open(file, 'rb') as f:
+                content = pickle.load(f)
+            path = os.path.join(target, os.path.relpath(file, source))
+            os.makedirs(os.path.dirname(path), exist_ok= True)
+            atomic_dump(compressed(content, codec) if codec else content, path)
+        Manifest.from_day_pickles(target).save()
+
+    def copy_columnar(target, compression, shuffle):
+        Manifest.from_columnar(
+            convert_day_pickles(target= ColumnarStore(target, compression= compression, shuffle= shuffle))
+        ).save()
+
+    options = [('pickle', None, False)] + [
+        ('columnar', compression, shuffle)
+        for compression in [None, 'zlib', 'lzma'] for shuffle in [False, True]
+    ]
+    options.insert(1, ('pickle', 'zlib', False))
+    options.insert(2, ('pickle', 'lzma', False))
+
+    root = tempfile.mkdtemp()
+    print(f'{"layout":<10}{"compression":<13}{"shuffle":<9}{"size MB":>9}{"on disk MB":>12}'
+          f'{"cold read s":>13}{"read cpu s":>12}{"Mrows/s":>9}')
+    try:
+        expected = None
+        for layout, compression, shuffle in options:
+            path = os.path.join(root, f'{layout}_{compression}_{shuffle}')
+            if layout == 'pickle': copy_pickles(path, compression)
+            else: copy_columnar(path, compression, shuffle)
+
+            stats = [os.stat(file) for file in files(path)]
+            size = sum(s.st_size for s in stats)
+            on_disk = sum(s.st_blocks * 512 for s in stats)
+
+            evict(path)
+            reader = PickledDataReader(path= path, backend= layout, cache_bytes= 0)
+            wall, cpu = time.perf_counter(), time.process_time()
+            result = reader.get_data(date1, date2, how= 'dataframe')
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            rows = sum(len(df) for df in result.values())
+
+            # Every option reads the same data
+            if expected is None: expected = result
+            assert expected.keys() == result.keys()
+            for station, df in result.items():
+                pd.testing.assert_frame_equal(df, expected[station], check_dtype= False)
+
+            print(f'{layout:<10}{str(compression):<13}{str(shuffle):<9}{size / 2**20:>9.1f}'
+                  f'{on_disk / 2**20:>12.1f}{wall:>13.3f}{cpu:>12.3f}{rows / wall / 1e6:>9.2f}')
+    finally:
+        shutil.rmtree(root)
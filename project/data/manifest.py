@@ -0,0 +1,219 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+
+try:
+    from .storage import atomic_dump
+except ImportError:  # Imported as a sibling by the preprocessor script
+    from storage import atomic_dump
+
+def manifest_path(data_path: os.path) -> os.path:
+    """Manifests are placed next to the data directory they describe"""
+    return os.path.normpath(data_path) + '_manifest.pickle'
+
+def source_manifest_path(data_path: os.path) -> os.path:
+    """Same as manifest_path, for the SourceManifest of the data directory"""
+    return os.path.normpath(data_path) + '_sources.pickle'
+
+def to_days(dates) -> np.ndarray:
+    """Sorted, unique datetime64[D] array of the dates"""
+    return np.unique(np.asarray(dates, dtype= 'datetime64[D]'))
+
+class Manifest(object):
+    """
+    Small index of the days available in a data directory, so readers
+    don't have to walk the file structure to answer which dates exist.
+    Keeps the days covered by each station, from which the available
+    dates and the coverage intervals of each station are derived.
+
+    Args:
+        path: path to the manifest file, see manifest_path
+    """
+    def __init__(self, path: os.path):
+        self.path = path
+        self.station_dates = {}  # station -> sorted datetime64[D] array
+        self.dates = np.array([], dtype= 'datetime64[D]')
+        self.mtime = None
+
+    @classmethod
+    def from_day_pickles(cls, data_path: os.path):
+        """Builds the manifest of the day pickle file structure under data_path"""
+        manifest = cls(manifest_path(data_path))
+        station_dates = {}
+        for dirpath, dirnames, filenames in os.walk(data_path):
+            for filename in filenames:
+                if os.path.splitext(filename)[1] != '.pickle': continue  # e.g. temporary files
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    content = pickle.load(f)
+                for station, data in content['hours'].items():
+                    station_dates.setdefault(station, []).extend(data['date'])
+        for station, dates in station_dates.items():
+            manifest.update(station, dates)
+        return manifest
+
+    @classmethod
+    def from_columnar(cls, store):
+        """Builds the manifest of a ColumnarStore"""
+        manifest = cls(manifest_path(store.path))
+        for station in store.get_stations():
+            for year in store.get_years(station):
+                manifest.update(station, store.read_partition(station, year)['date'])
+        return manifest
+
+    @classmethod
+    def load(cls, path: os.path):
+        manifest = cls(path)
+        with open(path, 'rb') as f:
+            manifest.station_dates = pickle.load(f)
+        manifest.mtime = os.stat(path).st_mtime_ns
+        manifest.__update_dates()
+        return manifest
+
+    def save(self):
+        atomic_dump(self.station_dates, self.path)
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+    def is_stale(self) -> bool:
+        """True if the manifest file has been rewritten since loaded/saved"""
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return False
+
+    def __update_dates(self):
+        self.dates = to_days(np.concatenate(
+            [self.dates[:0]] + list(self.station_dates.values())
+        ))
+
+    def update(self, station: str, dates):
+        """Adds the days of dates (datetimes or datetime64) to station"""
+        self.station_dates[station] = to_days(np.concatenate([
+            self.station_dates.get(station, np.array([], dtype= 'datetime64[D]')),
+            to_days(dates)
+        ]))
+        self.__update_dates()
+
+    def remove(self, station: str, days):
+        """Removes the days (datetimes or datetime64) from station"""
+        self.station_dates[station] = np.setdiff1d(
+            self.station_dates.get(station, np.array([], dtype= 'datetime64[D]')),
+            to_days(days)
+        )
+        self.__update_dates()
+
+    def contains(self, date) -> bool:
+        day = np.datetime64(date, 'D')
+        i = np.searchsorted(self.dates, day)
+        return i < len(self.dates) and self.dates[i] == day
+
+    def between(self, date1, date2) -> np.ndarray:
+        """Available days from the day of date1 to the day of date2, inclusive"""
+        lo = np.searchsorted(self.dates, np.datetime64(date1, 'D'), side= 'left')
+        hi = np.searchsorted(self.dates, np.datetime64(date2, 'D'), side= 'right')
+        return self.dates[lo:hi]
+
+    def get_earliest_date(self) -> np.datetime64:
+        return self.dates[0] if len(self.dates) else None
+
+    def get_latest_date(self) -> np.datetime64:
+        return self.dates[-1] if len(self.dates) else None
+
+    def get_years(self) -> list:
+        return sorted(set(
+            str(y) for y in self.dates.astype('datetime64[Y]').astype(int) + 1970
+        ))
+
+    def get_stations(self) -> list:
+        return list(self.station_dates.keys())
+
+    def coverage(self, station: str) -> list:
+        """List of (first day, last day) intervals of consecutive days covered by station"""
+        days = self.station_dates.get(station)
+        if days is None or not len(days): return []
+        breaks = np.flatnonzero(np.diff(days) > np.timedelta64(1, 'D'))
+        starts = np.concatenate([[0], breaks + 1])
+        ends = np.concatenate([breaks, [len(days) - 1]])
+        return [
+            (days[s].astype(object), days[e].astype(object))
+            for s, e in zip(starts, ends)
+        ]
+
+def fingerprint(path: os.path, size: int= None) -> str:
+    """Fast hash of the first size bytes of the file (all if None)"""
+    digest = hashlib.blake2b(digest_size= 16)
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(remaining, 2**20))
+            if not chunk: break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+class SourceManifest(object):
+    """
+    Keeps the size, mtime and hash of each raw file ingested into a data
+    directory, and the days of the partitions it produced, so ingestion
+    can skip unchanged files and rebuild only what changed files affect.
+
+    Args:
+        path: path to the manifest file, see source_manifest_path
+    """
+    def __init__(self, path: os.path):
+        self.path = path
+        self.files = {}  # file key -> dict of size, mtime, hash, kwrd and days
+
+    @classmethod
+    def load(cls, path: os.path):
+        """Loads the manifest at path, or an empty one if there is none yet"""
+        manifest = cls(path)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                manifest.files = pickle.load(f)
+        return manifest
+
+    def save(self):
+        atomic_dump(self.files, self.path)
+
+    def status(self, key: str, path: os.path) -> str:
+        """
+        Returns 'new' if the file has not been ingested, 'unchanged', 'appended'
+        if the file only grew since ingested, or 'changed' otherwise.
+        Size and mtime are compared first, the file is only hashed if they differ.
+        """
+        entry = self.files.get(key)
+        if entry is None: return 'new'
+
+        stat = os.stat(path)
+        if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']:
+            return 'unchanged'
+
+        if stat.st_size == entry['size'] and fingerprint(path) == entry['hash']:
+            entry['mtime'] = stat.st_mtime_ns  # Only touched
+            return 'unchanged'
+
+        if stat.st_size > entry['size'] and fingerprint(path, entry['size']) == entry['hash']:
+            return 'appended'
+        return 'changed'
+
+    def record(self, key: str, path: os.path, kwrd: str, days):
+        """Records the current state of the file and the days it produced"""
+        stat = os.stat(path)
+        self.files[key] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': fingerprint(path),
+            'kwrd': kwrd,
+            'days': to_days(days)
+        }
+
+    def remove(self, key: str):
+        self.files.pop(key, None)
+
+    def get_days(self, key: str) -> np.ndarray:
+        entry = self.files.get(key)
+        return entry['days'] if entry else np.array([], dtype= 'datetime64[D]')
+
+    def get_files(self, kwrd: str) -> list:
+        return [key for key, entry in self.files.items() if entry['kwrd'] == kwrd]
@@ -1,18 +1,77 @@
 import logging
 import os
 from datetime import datetime
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 import pickle
 from util import *
 from raw_reader import *
+from columnar import ColumnarStore, concat_columns, to_arrays, to_years
+from manifest import Manifest, SourceManifest, manifest_path, source_manifest_path
+from manifest import to_days
+from storage import atomic_dump, bump_generation, compressed
+from rollups import Rollups, rollups_path
 
 # Initialize processing steps for files to be read
+# The parsers read whole files at once, giving the same datapoints as reader and cleaner
 PROCESSORS = {
-    ps: {'reader': pump_reader, 'cleaner': pump_cleaner} for ps in PUMPSTATIONS
+    ps: {'reader': pump_reader, 'cleaner': pump_cleaner, 'parser': pump_parser}
+    for ps in PUMPSTATIONS
 }
-PROCESSORS['florida_sentrum'] = {'reader': weather_reader, 'cleaner': florida_cleaner}
-PROCESSORS['florida_uib'] = {'reader': weather_reader, 'cleaner': florida_uib_cleaner}
-PROCESSORS['tidevannsdata'] = {'reader': tide_reader, 'cleaner': tide_cleaner}
-PROCESSORS['snodybde'] = {'reader': weather_reader, 'cleaner': snowdepth_cleaner}
+PROCESSORS['florida_sentrum'] = {
+    'reader': weather_reader, 'cleaner': florida_cleaner, 'parser': florida_parser
+}
+PROCESSORS['florida_uib'] = {
+    'reader': weather_reader, 'cleaner': florida_uib_cleaner, 'parser': florida_uib_parser
+}
+PROCESSORS['tidevannsdata'] = {
+    'reader': tide_reader, 'cleaner': tide_cleaner, 'parser': tide_parser
+}
+PROCESSORS['snodybde'] = {
+    'reader': weather_reader, 'cleaner': snowdepth_cleaner, 'parser': snowdepth_parser
+}
+
+def watermarks_path(data_path: os.path) -> os.path:
+    """The high-water marks are placed next to the data directory, like the manifest"""
+    return os.path.normpath(data_path) + '_watermarks.pickle'
+
+def parse_file(reader: CSVFileReader, processor: dict, path: os.path):
+    """
+    Parses a raw file in bulk into a dict of arrays if the processor has a
+    parser, row by row into a list of datapoints otherwise. Module level,
+    so it can run in worker processes.
+    """
+    if 'parser' in processor: return reader.read_columns(path, processor['parser'])
+    return list(reader.read_file(path, processor['reader'], processor['cleaner']))
+
+def to_columns(parsed) -> dict:
+    """Columns (dict of arrays, 'date' as datetime64[us]) of a result of parse_file"""
+    if not isinstance(parsed, list): return parsed
+    if not parsed: return {'date': np.array([], dtype= 'datetime64[us]')}
+    return {
+        k: np.array([dp[k] for dp in parsed], dtype= 'datetime64[us]' if k == 'date' else None)
+        for k in parsed[0]
+    }
+
+def split_days(columns: dict):
+    """
+    Generates (day, dict of lists of values) for each day of the columns, the
+    rows of a day in the order they are in. The values are python objects, as
+    the cleaners return them, so they can be placed in the day pickles.
+    """
+    days = columns['date'].astype('datetime64[D]')
+    order = np.argsort(days, kind= 'stable')
+    days = days[order]
+    values = {k: v[order].tolist() for k, v in columns.items()}
+    unique = np.unique(days)
+    bounds = np.append(np.searchsorted(days, unique), len(days))
+    for day, lo, hi in zip(unique.tolist(), bounds[:-1], bounds[1:]):
+        yield day, {k: vals[lo:hi] for k, vals in values.items()}
+
+def days_of(parsed) -> set:
+    """Days (datetime.date) of the datapoints of a result of parse_file"""
+    if isinstance(parsed, list): return set(dp['date'].date() for dp in parsed)
+    return set(np.unique(parsed['date'].astype('datetime64[D]')).tolist())
 
 class Preprocessor(object):
     """
@@ -26,8 +85,35 @@ class Preprocessor(object):
 
         target_dir: path to directory where preprocessed files will be placed. If not
         specified it will create one in the same dir as this module.
+
+        layout: 'pickle' writes day pickles, 'columnar' writes station/year
+        arrays through ColumnarStore (read with backend= 'columnar').
+
+        max_buffered_days: memory cap of transform. The day files are buffered
+        in memory and written once each. When more days than this are buffered,
+        they are written (merged with the files) and the buffer cleared.
+        None buffers everything.
+
+        incremental: only read raw files that are new or changed since last
+        ingested (see SourceManifest, kept next to target_dir). The days a
+        changed file produced are rebuilt, and of files that only grew, the
+        datapoints later than the high-water mark of their processor (the
+        latest date ingested from it) are added. Re-running does not duplicate
+        anything. Set False to place everything.
+
+        jobs: number of worker processes parsing the raw files. The results
+        are placed in the same order as with one, so the output is the same.
+
+        compression: None, 'zlib' or 'lzma'. Files written (day pickles or
+        partitions) are compressed with it, and read as before. Files already
+        in target_dir are left as they are until rewritten.
+
+        shuffle: byte shuffle the numeric arrays before compressing them,
+        only for the columnar layout (see ColumnarStore).
     """
-    def __init__(self, reader: CSVFileReader, target_dir: os.path= None, processors= PROCESSORS):
+    def __init__(self, reader: CSVFileReader, target_dir: os.path= None, processors= PROCESSORS,
+                 layout= 'pickle', max_buffered_days: int= None, incremental= True, jobs: int= 1,
+                 compression: str= None, shuffle= False):
 
         self.logger = logging.getLogger('dev')
         self.logger.setLevel(logging.INFO)
@@ -35,14 +121,31 @@ class Preprocessor(object):
         self.reader = reader
 
         self.target = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), 'pickled_data'
+            os.path.dirname(os.path.abspath(__file__)),
+            'columnar_data' if layout == 'columnar' else 'pickled_data'
         ) if not target_dir else target_dir
         
         self.processors = processors
 
+        self.layout = layout
+
+        self.max_buffered_days = max_buffered_days
+
+        self.incremental = incremental
+
+        self.jobs = jobs
+
+        if shuffle and layout != 'columnar':
+            raise ValueError('shuffle is only supported by the columnar layout')
+        self.compression = compression
+        self.shuffle = shuffle
+
+    def store(self) -> ColumnarStore:
+        return ColumnarStore(self.target, compression= self.compression, shuffle= self.shuffle)
+
     def save(self, target, data):
-        with open(target, 'wb') as f:
-            pickle.dump(data, f, pickle.DEFAULT_PROTOCOL)
+        # Atomically, so the app can keep reading while ingesting
+        atomic_dump(data, target)
 
     def load(self, target):
         parent = os.path.dirname(target)
@@ -54,50 +157,335 @@ class Preprocessor(object):
         with open(target, 'rb') as f:
             return pickle.load(f)
 
+    def update_manifest(self, written: dict, build):
+        """
+        Adds the dates written for each station to the manifest of the
+        target dir, so readers pick up the new dates. Builds the manifest
+        from scratch (with build) if there is none yet, or starts from an
+        empty one if build is None (the target dir was empty).
+        """
+        path = manifest_path(self.target)
+        if not os.path.exists(path) and build is not None:
+            build().save()
+            return
+
+        manifest = Manifest.load(path) if os.path.exists(path) else Manifest(path)
+        for station, dates in written.items():
+            manifest.update(station, dates)
+        manifest.save()
+
+    def year_columns(self, year: int, stations) -> dict:
+        """Dict of station -> all its columns in year, read from the target dir"""
+        if self.layout == 'columnar':
+            store = self.store()
+            return {
+                station: store.read_partition(station, year)
+                for station in stations if year in store.get_years(station)
+            }
+
+        manifest = Manifest.load(manifest_path(self.target))
+        days = manifest.dates[to_years(manifest.dates) == year]
+        lists = {}
+        for day in days.astype(datetime):
+            for station, data in self.load(abspath(self.target, day))['hours'].items():
+                if station not in stations: continue
+                for k, vals in data.items():
+                    lists.setdefault(station, {}).setdefault(k, []).extend(vals)
+        return {station: to_arrays(columns) for station, columns in lists.items()}
+
+    def update_rollups(self, written: dict, replaced: dict):
+        """
+        Recomputes the rollups (see Rollups) of the years with written or
+        replaced days of each station. Builds them from scratch if there are
+        none yet, like update_manifest.
+        """
+        path = rollups_path(self.target)
+        if not os.path.exists(path):
+            if not os.path.exists(manifest_path(self.target)): return  # Nothing written
+            if self.layout == 'columnar':
+                Rollups.from_columnar(self.store()).save()
+            else:
+                Rollups.from_day_pickles(self.target).save()
+            return
+
+        years = {}  # year -> stations
+        for kwrd in set(written) | set(kwrd for kwrd, days in replaced.items() if days):
+            dates = list(written.get(kwrd, [])) + list(replaced.get(kwrd, []))
+            for year in np.unique(to_years(to_days(dates))).tolist():
+                years.setdefault(year, set()).add(kwrd)
+        if not years: return
+
+        rollups = Rollups.load(path)
+        for year, stations in sorted(years.items()):
+            columns = self.year_columns(year, stations)
+            for station in stations:
+                rollups.update(station, year, columns.get(station))
+        rollups.save()
+
+    def load_watermarks(self) -> dict:
+        """
+        Returns dict of processor key -> latest date ingested. Target dirs
+        written before the marks were kept get them from their latest files.
+        """
+        path = watermarks_path(self.target)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+
+        if not os.path.exists(manifest_path(self.target)): return {}
+        manifest = Manifest.load(manifest_path(self.target))
+
+        watermarks = {}
+        for kwrd, days in manifest.station_dates.items():
+            if not len(days): continue
+            if self.layout == 'columnar':
+                store = self.store()
+                dates = store.read_partition(kwrd, store.get_years(kwrd)[-1])['date']
+                watermarks[kwrd] = dates[-1].astype('datetime64[us]').astype(datetime)
+            else:
+                data = self.load(abspath(self.target, days[-1].astype(datetime)))
+                watermarks[kwrd] = max(data['hours'][kwrd]['date'])
+        return watermarks
+
+    def save_watermarks(self, watermarks: dict):
+        self.save(watermarks_path(self.target), watermarks)
+
+    def parse(self, files: list) -> dict:
+        """
+        Parses the (kwrd, path) files, in jobs worker processes if jobs > 1.
+        Returns dict of (kwrd, path) -> result of parse_file.
+        """
+        processors = [self.processors[kwrd] for kwrd, path in files]
+        paths = [path for kwrd, path in files]
+        if self.jobs > 1 and len(files) > 1:
+            with ProcessPoolExecutor(max_workers= min(self.jobs, len(files))) as executor:
+                results = list(executor.map(parse_file, repeat(self.reader), processors, paths))
+        else:
+            results = list(map(parse_file, repeat(self.reader), processors, paths))
+        return dict(zip(files, results))
+
+    def plan(self, watermarks: dict, sources: SourceManifest) -> dict:
+        """
+        Decides what to read of the raw files of each processor, and reads it.
+        The files are parsed in two parallel rounds: new and changed files
+        first, to know the days they affect, then the other files needed.
+
+        Returns:
+            Dict of kwrd -> the days (datetime.date) whose kwrd contents are
+            to be replaced, those produced by new, changed and removed files,
+            and a generator of the columns to place, a dict of arrays per file
+            (see to_columns): the rows on the replaced days, and those later
+            than the high-water mark of files that only grew. Files that are
+            unchanged and produced none of the replaced days are not read.
+            The marks and sources are updated as the generators are consumed.
+        """
+        paths, status, removed = {}, {}, {}
+        for kwrd in self.processors.keys():
+            paths[kwrd] = {
+                os.path.relpath(path, self.reader.root): path
+                for path in self.reader.get_paths(kwrd)
+            }
+            for key, path in paths[kwrd].items():
+                status[kwrd, key] = sources.status(key, path) if self.incremental else 'new'
+            removed[kwrd] = [key for key in sources.get_files(kwrd) if key not in paths[kwrd]]
+
+        # Changed files are read first to know all the days they affect
+        parsed = self.parse([
+            (kwrd, path) for kwrd in paths for key, path in paths[kwrd].items()
+            if status[kwrd, key] in ('new', 'changed')
+        ])
+        affected = {kwrd: set() for kwrd in paths}
+        for kwrd in paths if self.incremental else []:
+            for key, path in paths[kwrd].items():
+                if (kwrd, path) in parsed:
+                    affected[kwrd] |= set(sources.get_days(key).tolist()) | days_of(parsed[kwrd, path])
+            for key in removed[kwrd]:
+                affected[kwrd] |= set(sources.get_days(key).tolist())
+
+        # Then files that grew, and unchanged files that produced affected days
+        needed = []
+        for kwrd in paths:
+            affected_days = np.array(sorted(affected[kwrd]), dtype= 'datetime64[D]')
+            needed += [
+                (kwrd, path) for key, path in paths[kwrd].items()
+                if status[kwrd, key] == 'appended' or (
+                    status[kwrd, key] == 'unchanged' and
+                    np.isin(sources.get_days(key), affected_days).any()
+                )
+            ]
+        parsed.update(self.parse(needed))
+
+        def chunks(kwrd):
+            mark = watermarks.get(kwrd) if self.incremental else None
+            affected_days = np.array(sorted(affected[kwrd]), dtype= 'datetime64[D]')
+            for key, path in paths[kwrd].items():
+                if (kwrd, path) not in parsed: continue
+
+                columns = to_columns(parsed.pop((kwrd, path)))
+                dates = columns['date']
+                days = dates.astype('datetime64[D]')
+                if not self.incremental:
+                    keep = np.ones(len(dates), dtype= bool)
+                else:
+                    keep = np.isin(days, affected_days)
+                    if status[kwrd, key] == 'appended':
+                        keep |= True if mark is None else dates > np.datetime64(mark, 'us')
+
+                if keep.any():
+                    latest = dates[keep].max()
+                    if kwrd not in watermarks or latest > np.datetime64(watermarks[kwrd], 'us'):
+                        watermarks[kwrd] = latest.astype(datetime)
+                    yield {k: v[keep] for k, v in columns.items()}
+                sources.record(key, path, kwrd, days)
+
+            for key in removed[kwrd]: sources.remove(key)
+
+        return {kwrd: (affected[kwrd], chunks(kwrd)) for kwrd in paths}
+
+    def flush(self, buffered: dict, replaced: set):
+        """
+        Writes the buffered days to their files, after the contents already
+        in the files, and clears the buffer. The contents of the (day, kwrd)
+        pairs in replaced are dropped first (once). Files left empty are removed.
+        """
+        for day, hours in buffered.items():
+            target = abspath(self.target, day)
+            data = self.load(target)
+            for kwrd, columns in hours.items():
+                if (day, kwrd) in replaced:
+                    data['hours'].pop(kwrd, None)
+                    replaced.discard((day, kwrd))
+                if not columns: continue
+                existing = data['hours'].setdefault(kwrd, {})
+                for k, vals in columns.items():
+                    existing.setdefault(k, []).extend(vals)
+
+            if data['hours']:
+                self.save(target, compressed(data, self.compression) if self.compression else data)
+            elif os.path.exists(target): os.remove(target)
+        buffered.clear()
+
+    def update_sources(self, sources: SourceManifest, watermarks: dict, written: dict,
+                       replaced: dict, build):
+        """
+        Saves the manifests and the high-water marks after a transform,
+        and increases the generation number of the target dir if it changed
+        """
+        path = manifest_path(self.target)
+        if os.path.exists(path) and any(replaced.values()):
+            manifest = Manifest.load(path)
+            for kwrd, days in replaced.items():
+                if days: manifest.remove(kwrd, list(days))
+            manifest.save()
+
+        self.update_manifest(written, build)
+        self.update_rollups(written, replaced)
+        sources.save()
+        self.save_watermarks(watermarks)
+
+        # Last, when everything is in place
+        if written or any(replaced.values()):
+            self.logger.info(f'{self.target} is at generation {bump_generation(self.target)}')
+
     def transform(self):
         """
         Places all datapoints read from reader into files given by the path:
         target_dir/[year]/[month]/[day].pickle
 
-        The file is pickled dictionary with pickle_keys as keys
-
-        Args:
-            pickle_keys: Must be a filename or directory on the path to the
-            raw dataset. Distributes the datapoints under that directory/file in the 
-            corresponding pickled date dictionary stored under the pickle key.
+        The file is pickled dictionary with the processor keys as keys.
+        All sources are merged by day in memory first, so each file is
+        loaded and written once (per flush, see max_buffered_days).
+        When incremental, only the days with new or changed data are touched.
         """
-        last_datapoint = None
+        if self.layout == 'columnar': return self.transform_columnar()
+
+        empty = not os.path.isdir(self.target) or not os.listdir(self.target)
+        watermarks = self.load_watermarks()
+        sources = SourceManifest.load(source_manifest_path(self.target))
+        plans = self.plan(watermarks, sources)
+        buffered = {}  # day -> kwrd -> measurement -> list
+        replaced = {}  # kwrd -> days whose contents are replaced
+        pending = set()  # (day, kwrd) pairs not yet replaced, see flush
+        written = {}  # Dates of the days written for each kwrd
         # These correspond to files or directories
         # Their values are descriptions of how to process the respective files under kwrd
         for kwrd in self.processors.keys():
-            for datapoint in self.reader.read(
-                self.processors[kwrd]['reader'],
-                self.processors[kwrd]['cleaner'],
-                dir_or_filename= kwrd
-            ):
+            replaced[kwrd], chunks = plans[kwrd]
+            for day in replaced[kwrd]:
+                buffered.setdefault(day, {})[kwrd] = {}
+                pending.add((day, kwrd))
 
-                # Open a new file if first time through loop or new day
-                if not last_datapoint or last_datapoint['date'].date() != datapoint['date'].date():
+            for columns in chunks:
+                for day, values in split_days(columns):
+                    if day not in buffered:
+                        if self.max_buffered_days and len(buffered) >= self.max_buffered_days:
+                            self.flush(buffered, pending)
+                        buffered[day] = {}
+                    hours = buffered[day].setdefault(kwrd, {})
+                    written.setdefault(kwrd, []).append(day)
+                    for k, vals in values.items():
+                        hours.setdefault(k, []).extend(vals)
 
-                    # Save modified datastructure if not first time trough loop
-                    if last_datapoint != None: self.save(target, data)
+        self.flush(buffered, pending)
 
-                    target = abspath(self.target, datapoint['date'])
- 
-                    data = self.load(target)
+        self.update_sources(
+            sources, watermarks, written, replaced,
+            None if empty else lambda: Manifest.from_day_pickles(self.target)
+        )
 
-                for k in datapoint.keys():
-                    data['hours'].setdefault(kwrd, {}).setdefault(k, []).append(datapoint[k])
-                
-                last_datapoint = datapoint     
+    def transform_columnar(self):
+        """
+        Same as transform, but appends the columns of each processor
+        to the station/year partitions of a ColumnarStore under target_dir.
+        Only the partitions of years with new or changed data are rewritten.
+        """
+        store = self.store()
+        empty = not store.get_stations()
+        watermarks = self.load_watermarks()
+        sources = SourceManifest.load(source_manifest_path(self.target))
+        plans = self.plan(watermarks, sources)
+        replaced = {}
+        written = {}
+
+        for kwrd in self.processors.keys():
+            replaced[kwrd], chunks = plans[kwrd]
+            chunks = list(chunks)
+            columns = concat_columns(*chunks) if chunks else {}
+            if columns: columns['date'] = columns['date'].astype('datetime64[ns]')
+            if columns or replaced[kwrd]:
+                store.append(
+                    kwrd, columns, np.array(sorted(replaced[kwrd]), dtype= 'datetime64[D]')
+                )
+            if columns:
+                written[kwrd] = columns['date']
 
-        self.save(target, data)
+        self.update_sources(
+            sources, watermarks, written, replaced,
+            None if empty else lambda: Manifest.from_columnar(store)
+        )
 
 # Run to create pickled, preprocessed data folder
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description= 'Ingest the raw data')
+    parser.add_argument('--jobs', type= int, default= os.cpu_count(),
+                        help= 'worker processes parsing the raw files')
+    parser.add_argument('--layout', choices= ['pickle', 'columnar'], default= 'pickle')
+    parser.add_argument('--full', action= 'store_true',
+                        help= 'place everything, not only new and changed data')
+    parser.add_argument('--raw', help= 'directory of the raw files (default raw_data)')
+    parser.add_argument('--compression', choices= ['zlib', 'lzma'],
+                        help= 'compress the files written')
+    parser.add_argument('--shuffle', action= 'store_true',
+                        help= 'byte shuffle the arrays before compressing (columnar layout)')
+    args = parser.parse_args()
 
-    csv_reader = CSVFileReader()
+    csv_reader = CSVFileReader(args.raw)
 
-    preprocessor = Preprocessor(reader=csv_reader)
+    preprocessor = Preprocessor(
+        reader=csv_reader, layout= args.layout, incremental= not args.full, jobs= args.jobs,
+        compression= args.compression, shuffle= args.shuffle
+    )
 
-    preprocessor.transform()
\ No newline at end of file
+    preprocessor.transform()
@@ -1,10 +1,12 @@
 import os
+import io
 import csv
 import logging
 import logging.config
 import yaml
 from datetime import datetime
 import numpy as np
+import pandas as pd
 
 with open('./project/logging.yaml', 'r') as f:
     log_cfg = yaml.safe_load(f.read())
@@ -48,6 +50,14 @@ class CSVFileReader(object):
         if len(self.paths) == 0:
             raise ValueError("The provided directory/file contained no csv files")
 
+    def get_paths(self, dir_or_filename= None) -> list:
+        """Paths of the csv files under dir_or_filename, everything if not specified"""
+        # Return everything under root if nothing is specified
+        if not dir_or_filename: dir_or_filename = os.path.dirname(self.root)
+
+        # Only return relevant files
+        return [path for path in self.paths if dir_or_filename in path]
+
     def read(self, reader, cleaner, dir_or_filename= None):
         """
         Yields processed/cleaned datapoints from the csv files under
@@ -60,18 +70,29 @@ class CSVFileReader(object):
             cleaner: callback that accepts individual rows from reader
             and returns a processed/cleaned datastructure from it.
         """
-        # Return everything under root if nothing is specified
-        if not dir_or_filename: dir_or_filename = os.path.dirname(self.root)
+        for path in self.get_paths(dir_or_filename):
+            yield from self.read_file(path, reader, cleaner)
 
-        for path in self.paths:
-            if dir_or_filename in path:  # Only return contents of relevant files
-                with open(path, encoding = "ISO-8859-1") as csvfile:
-                    for row in reader(csvfile):
-                        try:
-                            yield cleaner(row)
-                        except Exception as e:
-                            self.logger.warning(f'raw data: {row} could not be dealt with')
-                            print(e)
+    def read_file(self, path, reader, cleaner):
+        """Same as read, for one file"""
+        with open(path, encoding = "ISO-8859-1") as csvfile:
+            for row in reader(csvfile):
+                try:
+                    yield cleaner(row)
+                except Exception as e:
+                    self.logger.warning(f'raw data: {row} could not be dealt with')
+                    print(e)
+
+    def read_columns(self, path, parser) -> dict:
+        """
+        Same as read_file, but parses the whole file at once with a bulk
+        parser (see below) into a dict of arrays, one per measurement
+        """
+        with open(path, encoding = "ISO-8859-1") as csvfile:
+            columns, skipped = parser(csvfile)
+        if skipped:
+            self.logger.warning(f'raw data: {skipped} rows of {path} could not be dealt with')
+        return columns
 
 #-------------Cleaners and Readers to be used in above function-------------------------------------------------
 
@@ -112,12 +133,169 @@ def tide_cleaner(row: list):
     'level (cm)': float(row[3] or row[4] or row[5]) # Use the non-empty element
     }
 
+#-------------Bulk parsers, same datapoints as the readers and cleaners above for whole files-------------------
+# Each returns a dict of arrays ('date' as datetime64) and the number of rows skipped
+
+def split_lines(f, delimiter: str) -> pd.DataFrame:
+    """
+    Splits the non-empty lines of the file into fields, as the csv readers do.
+    Returns a table with the i-th field of each line in column i, nan for
+    lines with fewer fields (where the cleaners get IndexErrors and Nones).
+    """
+    lines = '\n'.join(line for line in f.read().split('\n') if line)
+
+    # Number of fields of each line, from the positions of the delimiters
+    # (the file is decoded from ISO-8859-1, so each char is a byte)
+    chars = np.frombuffer(lines.encode('ISO-8859-1'), dtype= np.uint8)
+    ends = np.append(np.flatnonzero(chars == ord('\n')), len(chars))
+    starts = np.insert(ends[:-1] + 1, 0, 0)
+    delimiters = np.flatnonzero(chars == ord(delimiter))
+    n_fields = np.searchsorted(delimiters, ends) - np.searchsorted(delimiters, starts) + 1
+
+    if not lines: return pd.DataFrame()
+    table = pd.read_csv(
+        io.StringIO(lines), sep= delimiter, header= None, names= range(n_fields.max()),
+        dtype= str, keep_default_na= False, skip_blank_lines= False
+    )
+    return table.where(np.arange(len(table.columns)) < n_fields[:, None])
+
+def field(table: pd.DataFrame, i: int) -> pd.Series:
+    """Column i of a table from split_lines, all nan if no line has that many fields"""
+    if i in table.columns: return table[i]
+    return pd.Series(np.nan, index= table.index, dtype= object)
+
+def to_float(strings: pd.Series) -> pd.Series:
+    """float(s) of each string, nan where it fails"""
+    return pd.to_numeric(strings, errors= 'coerce')
+
+def decimal_comma(strings: pd.Series) -> pd.Series:
+    return strings.str.replace(',', '.', regex= False)
+
+def optional_float(strings: pd.Series):
+    """
+    Same as the cleaners' float(s.replace(',', '.')) if s has digits else nan.
+    Returns the values and a mask of the strings that could be dealt with.
+    """
+    has_digit = strings.str.contains(r'\d', regex= True).fillna(False).astype(bool)
+    values = to_float(decimal_comma(strings))
+    valid = strings.notna() & (~has_digit | values.notna())
+    return values.where(has_digit, np.nan), valid
+
+def valid_columns(columns: dict, valid: pd.Series):
+    """Keeps the valid rows of the columns as arrays, see the parsers"""
+    arrays = {k: v[valid].to_numpy() for k, v in columns.items()}
+    arrays['date'] = arrays['date'].astype('datetime64[us]')
+    return arrays, int((~valid).sum())
+
+def weather_fields(f):
+    """
+    Splits a weather file like weather_reader. Returns a function giving
+    the column of a header name (nan where rows are too short), like the
+    values of the rows of the csv.DictReader.
+    """
+    table = split_lines(f, ';')
+    # The first line holds the names
+    header = {name: i for i, name in table.iloc[0].dropna().items()} if len(table) else {}
+    rows = table.iloc[1:].reset_index(drop= True)
+
+    def column(name):
+        return field(rows, header.get(name, -1))
+    return column
+
+def pump_parser(f):
+    table = split_lines(f, '\t')
+    columns = {
+        'date': pd.to_datetime(field(table, 0), format= '%Y-%m-%d %H:%M', errors= 'coerce'),
+        'quantity (l/s)': to_float(decimal_comma(field(table, 2))),
+        'level (m)': to_float(decimal_comma(field(table, 4)))
+    }
+    return valid_columns(columns, pd.DataFrame(columns).notna().all(axis= 1))
+
+def florida_parser(f):
+    column = weather_fields(f)
+    date = pd.to_datetime(column('Tid(norsk normaltid)'), format= '%d.%m.%Y %H:%M', errors= 'coerce')
+    temp, temp_valid = optional_float(column('Lufttemperatur'))
+    precipitation, precipitation_valid = optional_float(column('NedbÃ¸r (1 t)'))
+    return valid_columns(
+        {'date': date, 'temp (C)': temp, 'precipitation (mm)': precipitation},
+        date.notna() & temp_valid & precipitation_valid
+    )
+
+def florida_uib_parser(f):
+    column = weather_fields(f)
+    date = pd.to_datetime(column('Tid(norsk normaltid)'), format= '%d.%m.%Y %H:%M', errors= 'coerce')
+    precipitation, precipitation_valid = optional_float(column('NedbÃ¸r (1 t)'))
+    return valid_columns(
+        {'date': date, 'precipitation (mm)': precipitation},
+        date.notna() & precipitation_valid
+    )
+
+def snowdepth_parser(f):
+    column = weather_fields(f)
+    date = pd.to_datetime(column('Tid(norsk normaltid)'), format= '%d.%m.%Y', errors= 'coerce')
+    depth = column('SnÃ¸dybde')
+    valid = date.notna() & depth.str.fullmatch(r'\s*[+-]?\d+\s*').fillna(False).astype(bool)
+    return valid_columns(
+        {'date': date, 'snodybde (cm)': depth.where(valid, '0').astype(int)}, valid
+    )
+
+def tide_parser(f):
+    table = split_lines(f, ' ')
+    # Local time, the utc offset is dropped like in tide_cleaner
+    timestamp = field(table, 0)
+    iso = timestamp.str.fullmatch(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d([+-]\d\d:\d\d)?')
+    date = pd.to_datetime(
+        timestamp.str.slice(0, 19).where(iso.fillna(False).astype(bool)),
+        format= '%Y-%m-%dT%H:%M:%S', errors= 'coerce'
+    )
+    # The first non-empty of the fields 3, 4 and 5
+    value = field(table, 3)
+    for i in [4, 5]:
+        value = value.where(value.fillna('') != '', field(table, i))
+    level = to_float(value)
+    return valid_columns({'date': date, 'level (cm)': level}, date.notna() & level.notna())
+
+def columns_to_datapoints(columns: dict) -> list:
+    """The rows of the arrays returned by the parsers as datapoints, same as the cleaners return"""
+    keys = list(columns.keys())
+    return [
+        dict(zip(keys, row)) for row in zip(*(columns[k].tolist() for k in keys))
+    ]
+
+# Check that the bulk parsers give the same datapoints as the cleaners
+# on the raw files, and compare the time they take
 if __name__ == '__main__':
+    import time
 
     reader = CSVFileReader()
 
-    counter = 0
-    for row in reader.read(weather_reader, florida_uib_cleaner, 'florida_uib'):
-        if counter == 10: break
-        counter += 1
-        print(row)
\ No newline at end of file
+    sources = {
+        'pumpedata': (pump_reader, pump_cleaner, pump_parser),
+        'florida_sentrum': (weather_reader, florida_cleaner, florida_parser),
+        'florida_uib': (weather_reader, florida_uib_cleaner, florida_uib_parser),
+        'tidevannsdata': (tide_reader, tide_cleaner, tide_parser),
+        'snodybde': (weather_reader, snowdepth_cleaner, snowdepth_parser)
+    }
+
+    def same(a, b):  # nan == nan
+        return a == b or (a != a and b != b)
+
+    rows_time, bulk_time = 0, 0
+    for source, (row_reader, cleaner, parser) in sources.items():
+        for path in reader.get_paths(source):
+            start = time.perf_counter()
+            expected = list(reader.read_file(path, row_reader, cleaner))
+            rows_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            datapoints = columns_to_datapoints(reader.read_columns(path, parser))
+            bulk_time += time.perf_counter() - start
+
+            assert len(datapoints) == len(expected), path
+            for d, e in zip(datapoints, expected):
+                assert d.keys() == e.keys() and all(
+                    same(d[k], e[k]) and type(d[k]) == type(e[k]) for k in e
+                ), (path, d, e)
+            print(f'{os.path.basename(path)}: {len(datapoints)} datapoints equal')
+
+    print(f'row by row: {rows_time:.2f} s, bulk: {bulk_time:.2f} s')
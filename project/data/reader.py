@@ -3,9 +3,19 @@ import logging.config
 import yaml
 import os
 import pickle
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from datetime import datetime, timedelta
-from project.data.util import abspath, find_first_filepath, find_last_filepath, PUMPSTATIONS
+from functools import partial
+from project.data.util import day_paths, calendar_mask, PUMPSTATIONS
+from project.data.columnar import ColumnarStore, concat_columns, sort_columns, DATE
+from project.data.cache import LRUCache, uniform_sizeof
+from project.data.manifest import Manifest, manifest_path
+from project.data.storage import read_generation
+from project.data.records import windowed_blocks
+from project.data.rollups import Rollups, rollups_path, partials, merge_partials, can_serve, PERIOD
 
 
 with open('./project/logging.yaml', 'r') as f:
@@ -18,109 +28,169 @@ class PickledDataReader(object):
     Reader class that provides a convienent and fast API for accessing subsets
     of the preproccesd data points located in the file structure indicated
     by the variable "path". 
+
+    Args:
+        path: directory of the processed data. Defaults to pickled_data or
+        columnar_data next to this module, depending on backend.
+
+        backend: 'pickle' reads the day pickles, 'columnar' reads the
+        station/year arrays written by ColumnarStore.
+
+        mmap_mode: only for the columnar backend. If 'r', the partitions are
+        memory mapped (see ColumnarStore), so only the pages used are read.
+        The dataframes get_data returns are views of the maps only for queries
+        within one year of a station. Queries spanning years, such as the app's
+        full range, get copies joined by concat_columns, and the stream and
+        blocks modes copy too.
+
+        cache_bytes: byte budget of the LRU cache of decoded day files used by
+        get_file_content. 0 disables the cache. Counters in self.cache.stats().
+        The default holds all the shipped data (about 78 MB decoded). Reads of
+        more files than fit are not stored, so they don't flush the cache.
+
+        workers, read_ahead: number of threads get_file_content reads and decodes
+        day files with, and how many files it may load ahead of the consumer.
+        workers= 1 reads sequentially on the calling thread.
     """
-    def __init__(self, path= None):
+    def __init__(self, path= None, backend= 'pickle', mmap_mode= None, cache_bytes= 128 * 2**20,
+                 workers= 4, read_ahead= 32):
 
         self.logger = logging.getLogger('dev')
         self.logger.setLevel(logging.INFO)
 
+        self.backend = backend
+
         # Path to processed file directory
-        if path is None: self.path = os.path.normpath(
+        self.path = path or os.path.normpath(
             os.path.join(
-                os.path.dirname(__file__), 'pickled_data'
+                os.path.dirname(__file__),
+                'columnar_data' if backend == 'columnar' else 'pickled_data'
             )
         )
         
         self.logger.info(f'instantiating with reading dir: {self.path}')
+
+        if backend == 'columnar': self.store = ColumnarStore(self.path, mmap_mode)
+
+        self.cache = LRUCache(cache_bytes, uniform_sizeof) if cache_bytes else None
+
+        self.workers = workers
+        self.read_ahead = max(read_ahead, workers)
+        self.executor = None
+        self.executor_pid = None
+
+        # Index of available dates, see get_manifest
+        self.manifest = self.__load_manifest()
+
+        # Increased by the preprocessor each time it has written, see get_manifest
+        self.generation = read_generation(self.path)
+
+        # Partial aggregates of the data, see get_rollups
+        self.rollups = None
         
         # Used by get_data to determine read method
         self.read_as = {
             'dataframe': self.__as_dataframes,
-            'stream': self.__as_stream
+            'stream': self.__as_stream,
+            'blocks': self.__as_blocks
         }
 
-    def __path_to_date(self, path) -> datetime:
+        # Same as above, for the columnar backend
+        self.read_columns_as = {
+            'dataframe': self.__columns_as_dataframes,
+            'stream': self.__columns_as_stream,
+            'blocks': self.__columns_as_blocks
+        }
+
+    def __load_manifest(self) -> Manifest:
+        """Loads the manifest of self.path, or builds and saves it if missing"""
+        path = manifest_path(self.path)
+        if os.path.exists(path): return Manifest.load(path)
+
+        self.logger.info(f'No manifest found at {path}. Building it from {self.path}')
+        manifest = (
+            Manifest.from_columnar(self.store) if self.backend == 'columnar'
+            else Manifest.from_day_pickles(self.path)
+        )
         try:
-            date_string = os.path.splitext(os.path.relpath(path, self.path))[0]
-            return datetime.strptime(date_string, f'%Y{os.sep}%m{os.sep}%d')
-
-        except ValueError as ve:
-            import calendar
-            self.logger.warning(
-                f"""
-                Could not convert string {date_string} to datetime.
-                '{ve}'.
-                Use last day of month instead.
-                """
-            )
-            y, m = tuple(int(s) for s in date_string.split(os.sep)[:2])
-            return datetime(y, m, calendar.monthrange(y, m)[1])           
+            manifest.save()
+        except OSError as e:
+            self.logger.warning(f'Could not save manifest: {e}')
+        return manifest
 
-    def __resolve_dates(self, date1: datetime, date2: datetime):
+    def get_manifest(self) -> Manifest:
         """
-        Gives the provided dates a upper/minimum bound if not specified (is None)
-        or doesnt exist
+        The manifest of available dates, reloaded if rewritten by the preprocessor.
+        Also drops the cached day files when the data has a new generation.
         """
-        if not date1 or not os.path.exists(abspath(self.path, date1)):
-            path = find_first_filepath(self.path)
-            self.logger.warning(f'Too early/no date specified ({date1}) - no path found. Using earliest file insted {path}')
-            date1 = self.__path_to_date(path)
-
-        if not date2 or not os.path.exists(abspath(self.path, date2)):
-            path = find_last_filepath(self.path)
-            self.logger.warning(f'Too late/no date specified ({date2}) - no path found. Using earliest file insted {path}')
-            date2 =  self.__path_to_date(path)
-        return date1, date2
-
-    def __combine_path(self, path1, path2):
+        generation = read_generation(self.path)
+        if generation != self.generation:
+            self.logger.info(f'{self.path} is at generation {generation}')
+            self.generation = generation
+            if self.cache is not None: self.cache.clear()
+
+        if self.manifest.is_stale():
+            self.manifest = Manifest.load(self.manifest.path)
+        return self.manifest
+
+    def get_generation(self) -> int:
+        """Generation number of the data (see read_generation), e.g. to key cached query results"""
+        self.get_manifest()
+        return self.generation
+
+    def get_rollups(self) -> Rollups:
         """
-        Replaces the first part of path2 with path1
+        The rollups of the data (see Rollups), reloaded if rewritten by the
+        preprocessor. Built and saved the first time if missing, like the manifest.
         """
-        p1_tail = os.path.relpath(path1, self.path)
-        p2_tail = os.path.relpath(path2, self.path)
-
-        p1_parts = os.path.normpath(p1_tail).split(os.path.sep)
-        p2_parts = os.path.normpath(p2_tail).split(os.path.sep)
-        p2_parts = p2_parts[len(p1_parts):] if len(p2_parts) > len(p1_parts) else []
-        return os.path.join(self.path, *p1_parts, *p2_parts)
+        if self.rollups is not None and not self.rollups.is_stale(): return self.rollups
 
-    def __get_paths_to_basenames(self, paths: list, basenames: list, date1: datetime, date2: datetime):
-        """
-        Generates paths to basenames relative to paths between specified dates (if they exist).
+        path = rollups_path(self.path)
+        if os.path.exists(path):
+            self.rollups = Rollups.load(path)
+            return self.rollups
 
-        If basenames is None, generates paths to all subdirs under paths.
+        self.logger.info(f'No rollups found at {path}. Building them from {self.path}')
+        self.rollups = (
+            Rollups.from_columnar(self.store) if self.backend == 'columnar'
+            else Rollups.from_day_pickles(self.path)
+        )
+        try:
+            self.rollups.save()
+        except OSError as e:
+            self.logger.warning(f'Could not save rollups: {e}')
+        return self.rollups
 
-        If both dates is None, generates from all dates avalable.
+    def __resolve_dates(self, date1: datetime, date2: datetime):
         """
-        date1, date2 = self.__resolve_dates(date1, date2)
-
-        path1 = abspath(self.path, date1)
-        path2 = abspath(self.path, date2)
+        Gives the provided dates a upper/minimum bound if not specified (is None)
+        or outside the available dates
+        """
+        earliest, latest = self.get_earliest_date(), self.get_latest_date()
 
-        for path in paths:
-            for basename in os.listdir(path):
-                # Construct new path to subdirs
-                new_path = os.path.join(path, basename)
+        if not date1 or date1 < earliest:
+            self.logger.warning(f'Too early/no date specified ({date1}). Using earliest date insted {earliest}')
+            date1 = earliest
 
-                # If basename not specified, yield all paths to subdirs
-                # else yield the ones specified in basenames
-                if not basenames or os.path.splitext(os.path.basename(new_path))[0] in basenames:
-                    # Only yield if new path is between date1 and date2
-                    if (date1 <= self.__path_to_date(self.__combine_path(new_path, path1))
-                    and
-                    date2 >= self.__path_to_date(self.__combine_path(new_path, path2))):
-                        yield new_path
+        if not date2 or date2 >= latest + timedelta(days= 1):
+            self.logger.warning(f'Too late/no date specified ({date2}). Using latest date insted {latest}')
+            date2 = latest
+        return date1, date2
 
-    def __get_paths_between_dates(self, date1: datetime, date2: datetime):
+    def __plan_paths(self, date1: datetime, date2: datetime, years: list= None,
+                     months: list= None, days: list= None, weekdays: list= None):
         """
-        Returns paths to files with content belonging between the specified dates
+        Returns paths to the available day files between the specified dates that
+        match the calendar filters (see get_data). The days are taken from the
+        manifest and filtered arithmetically, without listing any directories.
         """
         date1, date2 = self.__resolve_dates(date1, date2)
-        return [
-            abspath(self.path, date) for date in [
-                (date2 - timedelta(x)) for x in range((date2 - date1).days + 1)
-            ]
-        ]
+        available = self.get_manifest().between(date1, date2)
+
+        if any([years, months, days, weekdays]):
+            available = available[calendar_mask(available, years, months, days, weekdays)]
+
+        return day_paths(self.path, available)
 
     def __as_dataframes(self, day_iterator):
         """
@@ -138,8 +208,9 @@ class PickledDataReader(object):
         for day in day_iterator:
             for station, data in day['hours'].items():  # Data is dict of measurments
                 if station not in dict_result:
-                    # Initilize the station to result with first dict of measurments
-                    dict_result[station] = data
+                    # Initilize the station to result with copy of first dict of measurments
+                    # (day contents may be shared through the cache, must not be extended)
+                    dict_result[station] = {meas: list(vals) for meas, vals in data.items()}
                 else:
                     for measurement in dict_result[station]:
                         # Extend the measurement at the station with measurement of next day
@@ -149,7 +220,8 @@ class PickledDataReader(object):
         }
         for df in dict_of_df.values():
             df.set_index('date', inplace= True)
-            df.sort_index(inplace= True)
+            # Stable, so repeated dates stay in the order of the files
+            df.sort_index(inplace= True, kind= 'stable')
         return dict_of_df
 
     def __as_stream(self, day_iterator):
@@ -162,66 +234,319 @@ class PickledDataReader(object):
             'vaerdata': {'temp': .., 'precipitation': ..},
             'pumpstation': {'quantity': .., 'level':..}
         }
+
+        The datapoints are compact read-only records (see records.Datapoint),
+        views of week long aligned blocks of the days, as for the columnar
+        backend. The days arrive in date order, so the stream is chronological
+        while holding one week at a time.
+        """
+        for block in self.__as_blocks(day_iterator, np.timedelta64(7, 'D')):
+            yield from block.records()
+
+    def __day_columns(self, day):
+        """
+        Converts the lists of a day file's stations to arrays sorted by date,
+        dates as datetime64 (the hours are not always in order in the files)
+        """
+        return {
+            station: sort_columns({
+                meas: np.array(vals, dtype= 'datetime64[ns]' if meas == DATE else None)
+                for meas, vals in data.items()
+            }) for station, data in day['hours'].items() if data[DATE]
+        }
+
+    def __as_blocks(self, day_iterator, size: np.timedelta64):
+        """
+        Generates records.Block objects: consecutive windows of length size where
+        each block holds an array per station and measurement, aligned to a
+        shared datetime64 index.
+        """
+        return windowed_blocks(map(self.__day_columns, day_iterator), size)
+
+    def __columns_as_dataframes(self, chunks):
+        """
+        Args:
+            chunks: dicts of stations and their columns read from the store,
+            see __get_columns
+
+        Returns:
+            A dict of dataframes corresponding to each station, same as __as_dataframes
+        """
+        station_parts = {}
+        for chunk in chunks:
+            for station, columns in chunk.items():
+                station_parts.setdefault(station, []).append(columns)
+
+        dict_of_df = {}
+        for station, parts in station_parts.items():
+            columns = parts[0] if len(parts) == 1 else concat_columns(*parts)
+
+            # copy= False keeps the columns as views of memory mapped arrays
+            dict_of_df[station] = pd.DataFrame(
+                {meas: vals for meas, vals in columns.items() if meas != DATE},
+                index= pd.DatetimeIndex(columns[DATE], name= 'date', copy= False),
+                copy= False
+            )
+        return dict_of_df
+
+    def __columns_as_stream(self, chunks):
+        """
+        Generates the datapoints of __as_stream from the columns read from the
+        store, in chronological order. The datapoints are compact read-only
+        records (see records.Datapoint), views of week long aligned blocks.
+        """
+        for block in windowed_blocks(chunks, np.timedelta64(7, 'D')):
+            yield from block.records()
+
+    def __columns_as_blocks(self, chunks, size: np.timedelta64):
+        """Same as __as_blocks, for the columnar backend"""
+        return windowed_blocks(chunks, size)
+
+    def __project(self, day_iterator, stations, measurements):
+        """
+        Restricts the contents of each day to the stations and measurements
+        specified (None means all). Stations left without any of the
+        measurements are dropped.
         """
         for day in day_iterator:
-            # Construct datapoints
-            hourly_data = {}
+            hours = {}
             for station, data in day['hours'].items():
-                for i, date in enumerate(data['date']):
-                    if not date in hourly_data: hourly_data[date] = {'date': date}
-                    hourly_data[date][station] = {
-                        meas: vals[i] for meas, vals in data.items() if meas != 'date'
+                if stations is not None and station not in stations: continue
+                if measurements is not None:
+                    data = {
+                        meas: vals for meas, vals in data.items()
+                        if meas == 'date' or meas in measurements
                     }
-            for datapoint in hourly_data.values():
-                yield datapoint
+                    if len(data) == 1: continue
+                hours[station] = data
+            yield {**day, 'hours': hours}
 
-    def get_earliest_date(self):
-        return self.__path_to_date(find_first_filepath(self.path))
+    def __get_columns(self, date1, date2, years, months, days, weekdays,
+                      stations, measurements):
+        """
+        Generates dicts of stations and their columns from the columnar store,
+        one per year (read when reached), filtered the same way as the paths
+        for the pickle backend. Only the stations and measurements specified
+        are read.
+        """
+        date1, date2 = self.__resolve_dates(date1, date2)
+
+        # Whole days are included, as with the day files
+        start = np.datetime64(date1.date(), 'ns')
+        end = np.datetime64(date2.date(), 'ns') + np.timedelta64(1, 'D')
+
+        for year in range(date1.year, date2.year + 1):
+            lo = max(start, np.datetime64(f'{year}-01-01', 'ns'))
+            hi = min(end, np.datetime64(f'{year + 1}-01-01', 'ns'))
+
+            chunk = {}
+            for station in self.store.get_stations():
+                if stations is not None and station not in stations: continue
+
+                columns = self.store.read(station, lo, hi, measurements)
+                if columns is None or len(columns) == 1: continue  # None of the measurements
 
-    def get_latest_date(self):
-        return self.__path_to_date(find_last_filepath(self.path))
+                if any([years, months, days, weekdays]):
+                    mask = calendar_mask(columns[DATE], years, months, days, weekdays)
+                    if not mask.any(): continue
+                    columns = {k: v[mask] for k, v in columns.items()}
 
-    def get_available_years(self): return os.listdir(self.path)
+                chunk[station] = columns
+            if chunk: yield chunk
+
+    def get_earliest_date(self) -> datetime:
+        return self.get_manifest().get_earliest_date().astype('datetime64[us]').astype(datetime)
+
+    def get_latest_date(self) -> datetime:
+        return self.get_manifest().get_latest_date().astype('datetime64[us]').astype(datetime)
+
+    def get_available_years(self): return self.get_manifest().get_years()
+
+    def get_coverage(self, station: str) -> list:
+        """Intervals (first day, last day) of consecutive days with data from station"""
+        return self.get_manifest().coverage(station)
 
     def get_stations(self):
         # Should change so reads from pickled corpus instead
         return PUMPSTATIONS + ['florida_uib', 'florida_sentrum', 'tidevannsdata', 'snodybde']
 
+    def __load(self, file_path):
+        """Returns the content of the day file, its mtime and its size on disk"""
+        try:
+            with open(file_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                return pickle.load(f), stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            # Removed by the preprocessor after the paths were planned
+            return {'hours': {}}, None, 0
+
+    def __load_cached(self, file_path, scan: int= 1):
+        """
+        Content of the day file, from the cache if there. Stored in it
+        if the scan (number of files) it is read in fits the cache.
+        """
+        if self.cache is None: return self.__load(file_path)[0]
+
+        try:
+            content = self.cache.get((file_path, os.stat(file_path).st_mtime_ns))
+        except FileNotFoundError:
+            content = None
+        if content is None:
+            # Keyed by the mtime of the file actually read, files are replaced
+            # atomically by the preprocessor while the app is serving
+            content, mtime, size = self.__load(file_path)
+            if mtime is not None:
+                # Sized from the size on disk, sizing every content costs more than decoding it
+                if self.cache.fits(scan): self.cache.put((file_path, mtime), content, hint= size)
+                else: self.cache.skip()
+        return content
+
+    def __get_executor(self) -> ThreadPoolExecutor:
+        # Threads don't survive a fork (e.g. gunicorn --preload), so create per process
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix= 'reader')
+            self.executor_pid = os.getpid()
+        return self.executor
+
     def get_file_content(self, paths: list):
+        """
+        Generates the decoded contents of the day files in paths, in the same
+        order as paths. Up to read_ahead files are loaded concurrently ahead
+        of the consumer. Contents are cached by path and modification time,
+        and must not be modified. Contents read are not stored if all of
+        paths would not fit in the cache (see LRUCache.fits).
+        """
+        if self.workers <= 1:
+            for file_path in paths:
+                yield self.__load_cached(file_path, len(paths))
+            return
+
+        executor = self.__get_executor()
+        pending = deque()
         for file_path in paths:
-            with open(file_path, 'rb') as f:
-                yield pickle.load(f)
+            pending.append(executor.submit(self.__load_cached, file_path, len(paths)))
+            if len(pending) >= self.read_ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
     def get_data(self, date1: datetime= None, date2: datetime= None, years:list= None,
-                months: list= None, days:list= None, weekdays: list= [], how= 'dataframe'):
+                months: list= None, days:list= None, weekdays: list= [], how= 'dataframe',
+                stations: list= None, measurements: list= None, block_size: timedelta= timedelta(days= 7)):
         """
-        Generates all contentes af all files specified by the arguments:
+        Generates all contentes af all files specified by the arguments.
+        With how= 'stream' the datapoints are yielded lazily in chronological
+        order, so there is no need to sort them.
 
         Args:
             date1, date2: Yields contents between these. Unspecified yields from first date available to last
             years, months, days: Specify a list of years, months and days you would 
                 like to see content from between date1 and date2.
                 Unspecified yields everything available from that time period
+            stations, measurements: Only include these stations and measurements
+                (e.g. ['WolffsGate'], ['quantity (l/s)']). Unspecified includes all.
+                With the columnar backend the rest is not read at all.
+            how: 'dataframe' returns a dict of dataframes, one per station. 'stream'
+                generates datapoints in chronological order. 'blocks' generates
+                records.Block objects, consecutive windows of length block_size
+                with aligned numpy arrays per station and measurement.
         
         Example:
             get_data(date1= date, years= ['2011]) yields all contents from date1 only in 2011
         """
-        if not any([years, months, days]):  # if these not specified, just use date range to construct paths. Faster
-            paths = self.__get_paths_between_dates(date1, date2)
+        if self.backend == 'columnar':
+            read = self.read_columns_as[how]
+            content = self.__get_columns(date1, date2, years, months, days, weekdays,
+                                         stations, measurements)
         else:
-            # Construct full paths
-            paths = [self.path]
-            for time_periods in [years, months, days]:
-                paths = self.__get_paths_to_basenames(paths, time_periods, date1, date2)
-
-        # Filter, based on weekdays specified
-        if weekdays:
-            paths = (
-                path for path in paths
-                if self.__path_to_date(path).isoweekday() in weekdays
+            read = self.read_as[how]
+            content = self.get_file_content(
+                self.__plan_paths(date1, date2, years, months, days, weekdays)
             )
+            if stations is not None or measurements is not None:
+                content = self.__project(content, stations, measurements)
 
-        return self.read_as[how](self.get_file_content(paths))
+        if how == 'blocks': read = partial(read, size= np.timedelta64(block_size))
+
+        return read(content)
+
+    def get_values(self, columns: dict, date1: datetime= None, date2: datetime= None,
+                   years: list= None, months: list= None, days: list= None,
+                   weekdays: list= None, hours: tuple= None) -> dict:
+        """
+        The hourly values of the columns (dict of station -> measurements)
+        in one read, as dict of (station, measurement) -> arrays (dates, values).
+        Filtered as in aggregate. A date is included once with its last value,
+        like in the stream.
+        """
+        measurements = list(set(m for meas in columns.values() for m in meas))
+        dfs = self.get_data(date1, date2, years, months, days, weekdays or [],
+                            stations= list(columns), measurements= measurements)
+
+        values = {}
+        for station, meas in columns.items():
+            df = dfs.get(station)
+            if df is not None:
+                df = df[~df.index.duplicated(keep= 'last')]
+                if hours is not None:
+                    df = df[(hours[0] <= df.index.hour) & (df.index.hour <= hours[1])]
+            for m in meas:
+                values[station, m] = (
+                    (df.index.to_numpy(), df[m].to_numpy(float)) if df is not None and m in df
+                    else (np.array([], dtype= 'datetime64[ns]'), np.array([]))
+                )
+        return values
+
+    def aggregate(self, station: str, measurement: str, grain: str, date1: datetime= None,
+                  date2: datetime= None, years: list= None, months: list= None, days: list= None,
+                  weekdays: list= None, hours: tuple= None) -> dict:
+        """
+        Partial aggregates (see rollups.partials) of the hourly values of a
+        station's measurement between date1 and date2 by the groups of grain,
+        without reading the hourly data of the groups whose periods lie
+        within the range: those are taken from the rollups. The hourly data
+        of the periods cut by the range edges is read and merged with them.
+        None if there is no data.
+
+        Args:
+            years, months, days, weekdays: filters of the hours as in get_data
+            hours: only include the hours of day from hours[0] to hours[1] (inclusive)
+
+        Raises ValueError if the filters split the groups of grain, see rollups.can_serve
+        """
+        if not can_serve(grain, months, days, weekdays, hours):
+            raise ValueError(f'The groups of {grain} can not be merged with these filters')
+
+        date1, date2 = self.__resolve_dates(date1, date2)
+        first, last = np.datetime64(date1.date(), 'D'), np.datetime64(date2.date(), 'D')
+
+        interior = self.get_rollups().get(station, measurement, grain, first, last)
+        if interior is not None:
+            mask = calendar_mask(interior['label'], years, months, days, weekdays)
+            if hours is not None:
+                hour = (interior['label'] - interior['label'].astype('datetime64[D]')).astype(int)
+                mask &= (hours[0] <= hour) & (hour <= hours[1])
+            interior = {k: v[mask] for k, v in interior.items()}
+
+        # The periods at the edges of the range, unless it starts/ends with one
+        period = PERIOD[grain]
+        start = first.astype(f'datetime64[{period}]')
+        end = last.astype(f'datetime64[{period}]')
+        edges = []
+        if start.astype('datetime64[D]') != first:
+            edges.append((first, min(last, (start + 1).astype('datetime64[D]') - 1)))
+        if (end + 1).astype('datetime64[D]') - 1 != last and (not edges or end != start):
+            edges.append((max(first, end.astype('datetime64[D]')), last))
+
+        parts = [interior]
+        for edge_first, edge_last in edges:
+            dates, values = self.get_values(
+                {station: [measurement]},
+                *[d.astype('datetime64[us]').astype(datetime) for d in (edge_first, edge_last)],
+                years, months, days, weekdays, hours
+            )[station, measurement]
+            if len(dates): parts.append(partials(dates, values, grain))
+        return merge_partials(*parts)
 
 
 # For testing
@@ -247,7 +572,7 @@ if __name__ == "__main__":
     
     # Test if datapoints read in correct order (first to last by date)
     # Test if time difference between datapoints more than one hour
-    def test_correct_order():  # Not working
+    def test_correct_order():
         last = None
         for data in reader.get_data(how='stream'):
             date = data['date']
@@ -267,4 +592,15 @@ if __name__ == "__main__":
                       Warning: Difference between last date and current
                       is {diff}
                       """)
-            last = date
\ No newline at end of file
+            last = date
+
+    # Benchmark calendar filtered queries, e.g. all januaries, weekdays only
+    import time
+    for name, filters in {
+        'januaries, weekdays': dict(months= ['01'], weekdays= [1, 2, 3, 4, 5]),
+        'mondays 2015-2017': dict(years= ['2015', '2016', '2017'], weekdays= [1]),
+        '1st and 15th': dict(days= ['01', '15'])
+    }.items():
+        start = time.perf_counter()
+        result = reader.get_data(how= 'dataframe', **filters)
+        print(f'{name}: {time.perf_counter() - start:.3f} s')
@@ -0,0 +1,232 @@
+from collections.abc import Mapping
+import numpy as np
+from project.data.columnar import DATE
+
+class Block(object):
+    """
+    Time aligned chunk of data from several stations. All stations share the
+    sorted, unique datetime64 index dates. columns holds an array per station
+    and measurement aligned to dates, and present a boolean array per station
+    telling which dates the station has data for (the other values are nan/0).
+    """
+    def __init__(self, dates: np.ndarray, columns: dict, present: dict):
+        self.dates = dates
+        self.columns = columns
+        self.present = present
+        self.__datetimes = None
+
+    @classmethod
+    def align(cls, station_columns: dict):
+        """
+        Creates a block from a dict of stations and their (unaligned) columns,
+        each including a sorted 'date' array. If a station has a date more than
+        once, its last values are used.
+        """
+        dates = np.unique(np.concatenate(
+            [columns[DATE] for columns in station_columns.values()]
+        ))
+        aligned, present = {}, {}
+        for station, columns in station_columns.items():
+            idx = np.searchsorted(dates, columns[DATE])
+            present[station] = np.zeros(len(dates), dtype= bool)
+            present[station][idx] = True
+
+            aligned[station] = {}
+            for meas, vals in columns.items():
+                if meas == DATE: continue
+                full = (
+                    np.full(len(dates), np.nan) if vals.dtype.kind == 'f'
+                    else np.zeros(len(dates), dtype= vals.dtype)
+                )
+                full[idx] = vals
+                aligned[station][meas] = full
+        return cls(dates, aligned, present)
+
+    @property
+    def datetimes(self) -> list:
+        """dates as datetime objects, converted once per block"""
+        if self.__datetimes is None:
+            self.__datetimes = self.dates.astype('datetime64[us]').tolist()
+        return self.__datetimes
+
+    def __len__(self): return len(self.dates)
+
+    def take(self, keep: np.ndarray):
+        """Block of the rows where keep (boolean array aligned to dates) is True"""
+        return Block(
+            self.dates[keep],
+            {station: {meas: vals[keep] for meas, vals in columns.items()}
+             for station, columns in self.columns.items()},
+            {station: present[keep] for station, present in self.present.items()}
+        )
+
+    def records(self):
+        """Generates a Datapoint for each date in the block"""
+        for row in range(len(self.dates)):
+            yield Datapoint(self, row)
+
+class StationValues(Mapping):
+    """Read-only mapping of measurement -> value of one station at one row of a block"""
+    __slots__ = ('_columns', '_row')
+
+    def __init__(self, columns: dict, row: int):
+        self._columns = columns
+        self._row = row
+
+    def __getitem__(self, meas):
+        return self._columns[meas].item(self._row)
+
+    def __contains__(self, meas): return meas in self._columns
+
+    def __iter__(self): return iter(self._columns)
+
+    def __len__(self): return len(self._columns)
+
+    def __repr__(self): return repr(dict(self))
+
+class Datapoint(Mapping):
+    """
+    Compact, read-only stream element. A view of one row of a Block that
+    behaves like the datapoint dicts of the stream:
+
+    {
+        'date': datetime object,
+        'station': {'measurement': value, ..},
+        ..
+    }
+
+    Stations without data at the date are not keys of the datapoint.
+    Use dict(datapoint) (and dict(datapoint[station])) for a mutable copy.
+    """
+    __slots__ = ('_block', '_row')
+
+    def __init__(self, block: Block, row: int):
+        self._block = block
+        self._row = row
+
+    def __getitem__(self, key):
+        if key == DATE:
+            return self._block.datetimes[self._row]
+        present = self._block.present.get(key)
+        if present is None or not present[self._row]:
+            raise KeyError(key)
+        return StationValues(self._block.columns[key], self._row)
+
+    def __contains__(self, key):
+        if key == DATE: return True
+        present = self._block.present.get(key)
+        return present is not None and bool(present[self._row])
+
+    def __iter__(self):
+        yield DATE
+        for station, present in self._block.present.items():
+            if present[self._row]: yield station
+
+    def __len__(self): return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr({key: self[key] for key in self})
+
+def windowed_blocks(chunks, size: np.timedelta64):
+    """
+    Generates Blocks of consecutive windows of length size, starting at
+    midnight of the first date in chunks. Windows without data are skipped.
+
+    Args:
+        chunks: iterable of dicts of stations and their columns (including a
+        sorted 'date' array), in date order and not overlapping in time,
+        e.g. one per day file or per year. Only read as the windows reach them.
+    """
+    window_end = None
+    pending = {}  # station -> list of columns within the current window
+
+    def flush():
+        block = Block.align({
+            station: {k: np.concatenate([p[k] for p in pieces]) for k in pieces[0]}
+            for station, pieces in pending.items()
+        })
+        pending.clear()
+        return block
+
+    for chunk in chunks:
+        while chunk:
+            first = min(columns[DATE][0] for columns in chunk.values())
+            if window_end is None:
+                start = first.astype('datetime64[D]').astype(first.dtype)
+                window_end = start + size
+
+            if first >= window_end:
+                # Chunk starts in a later window
+                if pending: yield flush()
+                window_end = start + ((first - start) // size + 1) * size
+
+            rest = {}
+            for station, columns in chunk.items():
+                split = np.searchsorted(columns[DATE], window_end)
+                if split > 0:
+                    pending.setdefault(station, []).append(
+                        {k: v[:split] for k, v in columns.items()}
+                    )
+                if split < len(columns[DATE]):
+                    rest[station] = {k: v[split:] for k, v in columns.items()}
+            chunk = rest
+
+    if pending: yield flush()
+
+
+# Compare memory per datapoint and iteration speed of the records both
+# backends stream and of the same datapoints as plain nested dicts
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+    from datetime import datetime
+    from project.data.reader import PickledDataReader
+
+    def consume(datapoints):
+        total = 0.
+        for dp in datapoints:
+            if 'florida_sentrum' in dp: total += dp['florida_sentrum']['precipitation (mm)']
+            if 'WolffsGate' in dp: total += dp['WolffsGate']['quantity (l/s)']
+        return total
+
+    def held(make):
+        """What make() returns, and the bytes allocated by it still held"""
+        tracemalloc.start()
+        result = make()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return result, size
+
+    for backend in ['pickle', 'columnar']:
+        reader = PickledDataReader(backend= backend, cache_bytes= 0)
+        date1, date2 = datetime(2010, 1, 1), datetime(2020, 7, 13)
+
+        start = time.perf_counter()
+        consume(reader.get_data(date1, date2, how= 'stream'))
+        elapsed = time.perf_counter() - start
+
+        records, records_size = held(lambda: list(reader.get_data(date1, date2, how= 'stream')))
+        dicts, dicts_size = held(lambda: [
+            {k: dict(v) if k != 'date' else v for k, v in dp.items()} for dp in records
+        ])
+        assert np.array_equal(consume(records), consume(dicts), equal_nan= True)
+
+        timings = {}
+        for kind, datapoints in [('records', records), ('dicts', dicts)]:
+            start = time.perf_counter()
+            consume(datapoints)
+            timings[kind] = time.perf_counter() - start
+
+        print(f'{backend}: stream and consume {elapsed:.2f} s, bytes per datapoint held: '
+              f'records {records_size / len(records):.0f}, dicts {dicts_size / len(dicts):.0f}, '
+              f'consume held: records {timings["records"]:.3f} s, dicts {timings["dicts"]:.3f} s')
+
+    # Same sum over the blocks, vectorized per week
+    reader = PickledDataReader(backend= 'columnar')
+    start = time.perf_counter()
+    total = 0.
+    for block in reader.get_data(date1, date2, how= 'blocks'):
+        for station, meas in [('florida_sentrum', 'precipitation (mm)'), ('WolffsGate', 'quantity (l/s)')]:
+            if station in block.columns:
+                total += block.columns[station][meas][block.present[station]].sum()
+    print(f'columnar blocks: consume {time.perf_counter() - start:.2f} s')
@@ -0,0 +1,303 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+try:
+    from .columnar import DATE
+    from .storage import atomic_dump, compressed
+except ImportError:  # Imported as a sibling by the preprocessor script
+    from columnar import DATE
+    from storage import atomic_dump, compressed
+
+def rollups_path(data_path: os.path) -> os.path:
+    """Rollups are placed next to the data directory they summarize, like the manifest"""
+    return os.path.normpath(data_path) + '_rollups.pickle'
+
+def labels(dates: np.ndarray, grain: str) -> np.ndarray:
+    """
+    datetime64[h] label of the group of each date at grain. The labels are
+    the index values project/util.py's aggregate_* functions give the groups:
+
+    'day': midnight of the day (aggregate_hours)
+    'month': first of the month
+    'month_hour': first of the month at the hour (aggregate_days)
+    'year_day_hour': the day of month in december of the year, at the hour (aggregate_months)
+    'month_day_hour': the month, day and hour in 2016, a leap year (aggregate_years)
+    """
+    hours = dates.astype('datetime64[h]')
+    days = dates.astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    if grain == 'day': return days.astype('datetime64[h]')
+    if grain == 'month': return months.astype('datetime64[h]')
+    if grain == 'month_hour': return months.astype('datetime64[h]') + (hours - days)
+    if grain == 'year_day_hour':
+        december = dates.astype('datetime64[Y]').astype('datetime64[M]') + 11
+        return december.astype('datetime64[D]') + (days - months) + (hours - days)
+    if grain == 'month_day_hour':
+        month = months - dates.astype('datetime64[Y]').astype('datetime64[M]')
+        leap = (np.datetime64('2016', 'M') + month).astype('datetime64[D]')
+        return leap + (days - months) + (hours - days)
+    raise ValueError(f'Unknown grain: {grain}')
+
+GRAINS = ['day', 'month', 'month_hour', 'year_day_hour']
+
+# Calendar period of the groups of each grain, as numpy datetime unit
+PERIOD = {'day': 'D', 'month': 'M', 'month_hour': 'M', 'year_day_hour': 'Y'}
+
+# Filters that split the groups of a grain, so its groups can't be merged from the rollups
+SPLIT_BY = {
+    'day': ['hours'],
+    'month': ['days', 'weekdays', 'hours'],
+    'month_hour': ['days', 'weekdays'],
+    'year_day_hour': ['months', 'weekdays']
+}
+
+def can_serve(grain: str, months: list= None, days: list= None, weekdays: list= None,
+              hours: tuple= None) -> bool:
+    """
+    True if the groups of grain with these filters (see get_data; hours is an
+    inclusive (first, last) hour of day range) can be merged from rollups
+    """
+    used = {
+        'months': months, 'days': days, 'weekdays': weekdays,
+        'hours': hours is not None and tuple(hours) != (0, 23)
+    }
+    return not any(used[f] for f in SPLIT_BY[grain])
+
+def partials(dates: np.ndarray, values: np.ndarray, grain: str) -> dict:
+    """
+    Partial aggregates of the values by the groups of grain: dict of sorted
+    'label' and per label 'count', 'sum', 'min', 'max' and 'm2' (sum of
+    squared deviations from the group mean) of the values that are not nan.
+    Groups with only nan values are kept with count 0, like pandas keeps them.
+    A date given more than once counts once, with its last value, as in the
+    datapoints and blocks of the reader.
+    """
+    order = np.argsort(dates, kind= 'stable')
+    last = np.append(dates[order][1:] != dates[order][:-1], True)
+    dates, values = dates[order][last], np.asarray(values, dtype= float)[order][last]
+
+    keys, inverse = np.unique(labels(dates, grain), return_inverse= True)
+    valid = ~np.isnan(values)
+    inverse, values = inverse[valid], values[valid]
+
+    count = np.bincount(inverse, minlength= len(keys))
+    total = np.bincount(inverse, values, minlength= len(keys))
+    with np.errstate(invalid= 'ignore', divide= 'ignore'):
+        mean = total / count
+    low, high = np.full(len(keys), np.nan), np.full(len(keys), np.nan)
+    np.fmin.at(low, inverse, values)
+    np.fmax.at(high, inverse, values)
+    return {
+        'label': keys, 'count': count, 'sum': total, 'min': low, 'max': high,
+        'm2': np.bincount(inverse, (values - mean[inverse]) ** 2, minlength= len(keys))
+    }
+
+def merge_partials(*parts) -> dict:
+    """
+    Merges partial aggregates (see partials) of the same grain into one,
+    combining the ones of equal labels, e.g. of interior periods read from
+    the rollups with those computed from the hourly data at a range edge.
+    """
+    parts = [p for p in parts if p is not None and len(p['label'])]
+    if not parts: return None
+
+    cat = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+    keys, inverse = np.unique(cat['label'], return_inverse= True)
+    if len(keys) == len(cat['label']):  # Disjoint, only sort
+        order = np.argsort(cat['label'])
+        return {k: v[order] for k, v in cat.items()}
+
+    count = np.bincount(inverse, cat['count'], minlength= len(keys)).astype(int)
+    total = np.bincount(inverse, cat['sum'], minlength= len(keys))
+    low, high = np.full(len(keys), np.nan), np.full(len(keys), np.nan)
+    np.fmin.at(low, inverse, cat['min'])
+    np.fmax.at(high, inverse, cat['max'])
+
+    # Chan et al.: m2 = sum of m2s + sum of n * (part mean - mean)^2
+    with np.errstate(invalid= 'ignore', divide= 'ignore'):
+        mean = total / count
+        part_mean = cat['sum'] / cat['count']
+    spread = np.where(cat['count'] > 0, cat['count'] * (part_mean - mean[inverse]) ** 2, 0)
+    m2 = np.bincount(inverse, cat['m2'] + spread, minlength= len(keys))
+    return {'label': keys, 'count': count, 'sum': total, 'min': low, 'max': high, 'm2': m2}
+
+def total_partial(part: dict) -> dict:
+    """All groups of a partial aggregate merged into one"""
+    return merge_partials({**part, 'label': np.zeros(len(part['label']), dtype= 'datetime64[h]')})
+
+def finalize(part: dict, method: str) -> np.ndarray:
+    """
+    Values of each group of the partial aggregate for method ('mean', 'sum',
+    'min', 'max' or 'std'), as pandas gives them: nan for groups without values,
+    except sum, which is 0
+    """
+    count = part['count']
+    with np.errstate(invalid= 'ignore', divide= 'ignore'):
+        if method == 'mean': return np.where(count > 0, part['sum'] / count, np.nan)
+        if method == 'sum': return part['sum']
+        if method in ('min', 'max'): return part[method]
+        if method == 'std': return np.where(count > 1, np.sqrt(part['m2'] / (count - 1)), np.nan)
+    raise ValueError(f'Method {method} can not be computed from partial aggregates')
+
+class Rollups(object):
+    """
+    Partial aggregates (see partials) of the hourly values of each station
+    and measurement at the grains in GRAINS, kept next to a data directory
+    by the preprocessor. Aggregations over long ranges merge these instead
+    of reading the hourly data. The groups of each grain lie within a year,
+    so they are kept per year, and only the years with new data are
+    recomputed when ingesting.
+
+    Args:
+        path: path to the rollups file, see rollups_path
+    """
+    def __init__(self, path: os.path):
+        self.path = path
+        self.stations = {}  # station -> year -> grain -> measurement -> partials
+        self.mtime = None
+
+    @classmethod
+    def from_day_pickles(cls, data_path: os.path):
+        """Builds the rollups of the day pickle file structure under data_path, a year at a time"""
+        rollups = cls(rollups_path(data_path))
+        for year in sorted(os.listdir(data_path)):
+            if not year.isnumeric(): continue
+            lists = {}
+            for dirpath, dirnames, filenames in os.walk(os.path.join(data_path, year)):
+                for filename in filenames:
+                    if os.path.splitext(filename)[1] != '.pickle': continue
+                    with open(os.path.join(dirpath, filename), 'rb') as f:
+                        content = pickle.load(f)
+                    for station, data in content['hours'].items():
+                        for meas, vals in data.items():
+                            lists.setdefault(station, {}).setdefault(meas, []).extend(vals)
+            for station, columns in lists.items():
+                rollups.update(station, int(year), {
+                    # pandas converts lists of datetime objects much faster than numpy
+                    meas: pd.DatetimeIndex(vals).to_numpy() if meas == DATE else np.array(vals, dtype= float)
+                    for meas, vals in columns.items()
+                })
+        return rollups
+
+    @classmethod
+    def from_columnar(cls, store):
+        """Builds the rollups of a ColumnarStore"""
+        rollups = cls(rollups_path(store.path))
+        for station in store.get_stations():
+            for year in store.get_years(station):
+                rollups.update(station, year, store.read_partition(station, year))
+        return rollups
+
+    @classmethod
+    def load(cls, path: os.path):
+        rollups = cls(path)
+        with open(path, 'rb') as f:
+            rollups.stations = pickle.load(f)
+        rollups.mtime = os.stat(path).st_mtime_ns
+        return rollups
+
+    def save(self):
+        # Compressed, as the rollups of the pickled data are committed with it
+        atomic_dump(compressed(self.stations, 'zlib'), self.path)
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+    def is_stale(self) -> bool:
+        """True if the rollups file has been rewritten since loaded/saved"""
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return False
+
+    def update(self, station: str, year: int, columns: dict):
+        """
+        Recomputes the rollups of station in year from all its hourly columns
+        of that year ('date' as datetime64). None or no dates removes them.
+        """
+        years = self.stations.setdefault(station, {})
+        if columns is None or not len(columns[DATE]):
+            years.pop(year, None)
+            return
+        years[year] = {
+            grain: {
+                meas: partials(columns[DATE], vals, grain)
+                for meas, vals in columns.items() if meas != DATE
+            } for grain in GRAINS
+        }
+
+    def get(self, station: str, measurement: str, grain: str, first: np.datetime64,
+            last: np.datetime64) -> dict:
+        """
+        Partial aggregates of the groups of grain whose periods lie within
+        the days first to last (inclusive), None if there are none
+        """
+        period = PERIOD[grain]
+        first, last = np.datetime64(first, 'D'), np.datetime64(last, 'D')
+        parts = []
+        for year, grains in self.stations.get(station, {}).items():
+            if not first.astype('datetime64[Y]').astype(int) + 1970 <= year \
+                    <= last.astype('datetime64[Y]').astype(int) + 1970:
+                continue
+            part = grains[grain].get(measurement)
+            if part is None: continue
+
+            start = part['label'].astype(f'datetime64[{period}]')
+            end = (start + 1).astype('datetime64[D]')  # Exclusive
+            inside = (start.astype('datetime64[D]') >= first) & (end <= last + 1)
+            parts.append({k: v[inside] for k, v in part.items()})
+        return merge_partials(*parts)
+
+    def get_years(self, station: str) -> list:
+        return sorted(self.stations.get(station, {}))
+
+
+# Check that aggregations merged from the rollups equal the ones of the
+# hourly dataframe (as the app computes them), and compare the time they take
+if __name__ == '__main__':
+    import time
+    from datetime import datetime
+    from project.data.reader import PickledDataReader
+    from project.data.util import stream_to_dataframe
+    from project.util import aggregate_from_rollups, filter_by_hours, AGGREGATIONS
+
+    cases = [  # columns, aggregations, date range, filters
+        ({'WolffsGate': ['quantity (l/s)', 'level (m)']}, [('hours', 'mean')],
+         datetime(2013, 3, 17), datetime(2019, 8, 9), {}),
+        ({'WolffsGate': ['quantity (l/s)'], 'florida_uib': ['precipitation (mm)'],
+          'florida_sentrum': ['precipitation (mm)', 'temp (C)']},
+         [('days', 'sum')], datetime(2012, 1, 15), datetime(2018, 11, 20), {'hour_pair': (6, 18)}),
+        ({'Nygardstangen': ['quantity (l/s)'], 'tidevannsdata': ['level (cm)']}, [('months', 'max')],
+         datetime(2011, 5, 3), datetime(2020, 2, 2), {'days': ['01', '15', '31']}),
+        ({'snodybde': ['snodybde (cm)'], 'florida_uib': ['precipitation (mm)']},
+         [('days', 'mean'), ('years', 'sum')], datetime(2010, 6, 1), datetime(2020, 7, 1), {'months': ['01', '02']}),
+    ]
+
+    for backend in ['pickle', 'columnar']:
+        reader = PickledDataReader(backend= backend, cache_bytes= 0)
+        reader.get_rollups()
+
+        for columns, aggregations, date1, date2, filters in cases:
+            filters = {'hour_pair': (0, 23), **filters}
+            start = time.perf_counter()
+            stream = reader.get_data(
+                date1, date2, filters.get('years'), filters.get('months'), filters.get('days'),
+                filters.get('weekdays', []), how= 'stream', stations= list(columns),
+                measurements= [m for meas in columns.values() for m in meas]
+            )
+            df = filter_by_hours(stream_to_dataframe(stream, columns), filters['hour_pair'])
+            expected = [df, df.agg({col: ['mean', 'max', 'min', 'median', 'sum', 'std'] for col in df.columns})]
+            for name, method in aggregations:
+                expected[0] = AGGREGATIONS[name](expected[0], method)
+            hourly = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = aggregate_from_rollups(reader, columns, aggregations, date1, date2, **filters)
+            merged = time.perf_counter() - start
+
+            for e, r in zip(expected, result):
+                r = r[e.columns]
+                assert (e.index == r.index).all() and np.allclose(
+                    e.to_numpy(float), r.to_numpy(float), rtol= 1e-9, atol= 1e-9, equal_nan= True
+                ), (aggregations, e, r)
+            print(f'{backend} {aggregations}: equal, hourly {hourly:.2f} s, rollups {merged:.2f} s')
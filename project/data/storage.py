@@ -0,0 +1,69 @@
+import os
+import zlib
+import lzma
+import pickle
+
+def atomic_write(path: os.path, write, mode= 'wb'):
+    """
+    Writes the file at path with write(f) to a temporary file next to it,
+    then renames that into place. Readers see the old or the new file,
+    never a partially written one.
+    """
+    tmp = os.path.join(
+        os.path.dirname(os.path.abspath(path)),
+        f'.{os.path.basename(path)}.{os.getpid()}.tmp'
+    )
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def atomic_dump(obj, path: os.path):
+    """Pickles obj to path with atomic_write"""
+    atomic_write(path, lambda f: pickle.dump(obj, f, pickle.DEFAULT_PROTOCOL))
+
+# Codecs files can be compressed with: name -> (compress, decompress)
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress)
+}
+
+class Reduce(object):
+    """Pickles as the call func(*args), so unpickling it returns what the call returns"""
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __reduce__(self): return self.func, self.args
+
+def compressed(obj, codec: str) -> Reduce:
+    """
+    Wraps obj so that it pickles compressed with codec (see CODECS).
+    The pickle still loads as obj (by calling the codec's decompress and
+    pickle.loads), so whatever reads the files needs no changes.
+    """
+    compress, decompress = CODECS[codec]
+    return Reduce(pickle.loads, Reduce(decompress, compress(pickle.dumps(obj, pickle.DEFAULT_PROTOCOL))))
+
+def generation_path(data_path: os.path) -> os.path:
+    """Generation numbers are placed next to the data directory they count, like its manifest"""
+    return os.path.normpath(data_path) + '_generation'
+
+def read_generation(data_path: os.path) -> int:
+    """
+    Generation number of the data directory, increased by the preprocessor
+    each time it has finished writing to it (0 if it never has). Readers and
+    caches can compare it to know if anything changed.
+    """
+    try:
+        with open(generation_path(data_path)) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def bump_generation(data_path: os.path) -> int:
+    generation = read_generation(data_path) + 1
+    atomic_write(generation_path(data_path), lambda f: f.write(str(generation)), mode= 'w')
+    return generation
@@ -21,6 +21,38 @@ def abspath(path, date: datetime):
         os.path.join(path, date.strftime('%Y/%m/%d') + '.pickle')
     )
 
+def day_paths(path, days: np.ndarray) -> list:
+    """
+    Same as abspath for an array of datetime64 days, without
+    converting each day to datetime
+    """
+    return [
+        os.path.normpath(os.path.join(path, day.replace('-', os.sep) + '.pickle'))
+        for day in np.datetime_as_string(days.astype('datetime64[D]'))
+    ]
+
+def calendar_mask(dates: np.ndarray, years: list= None, months: list= None,
+                  days: list= None, weekdays: list= None) -> np.ndarray:
+    """
+    Returns a boolean mask of the datetime64 dates that fall within the
+    specified years, months and days (e.g. ['2011'], ['01', '02'])
+    and weekdays (isoweekday ints). Unspecified filters match everything.
+    """
+    mask = np.ones(len(dates), dtype= bool)
+    day_numbers = dates.astype('datetime64[D]')
+    month_numbers = dates.astype('datetime64[M]')
+    components = [
+        (years, lambda: dates.astype('datetime64[Y]').astype(int) + 1970),
+        (months, lambda: month_numbers.astype(int) % 12 + 1),
+        (days, lambda: (day_numbers - month_numbers).astype(int) + 1),
+        # 1970-01-01 was a thursday (isoweekday 4)
+        (weekdays, lambda: (day_numbers.astype(int) + 3) % 7 + 1)
+    ]
+    for wanted, component in components:
+        if wanted:
+            mask &= np.isin(component(), [int(w) for w in wanted])
+    return mask
+
 def find_first_filepath(path: os.path) -> os.path:
     for dirpath, dirname, filenames in os.walk(path):
         for filename in filenames:
@@ -69,14 +101,35 @@ def merge_stations(result: dict, stations: dict, left_df: pd.DataFrame= None):
         stations= stations
     )
 
-def stream_to_dataframe(datapoints, stations):
-    
-    # Determine column names
+def column_names(stations: dict) -> dict:
+    """
+    Dataframe column names of the measurements of the stations (dict of
+    station -> measurements): dict of (measurement, station) -> name.
+    Measurements of several stations are suffixed with the station.
+    """
     all_meas = [m for meas in stations.values() for m in meas]
-    col_name = {
+    return {
         (m, s): (f'{m} ({s})' if all_meas.count(m) > 1 else m)
           for s, meas in stations.items() for m in meas
     }
+
+def select_columns(df: pd.DataFrame, queried: dict, stations: dict) -> pd.DataFrame:
+    """
+    The columns of the stations (dict of station -> measurements) from df,
+    the dataframe of the stations queried (as made by stream_to_dataframe),
+    named as in the dataframe of only these stations. The stations must be
+    the same, the measurements a subset.
+    """
+    names, new_names = column_names(queried), column_names(stations)
+    keys = [k for k in new_names if k in names and names[k] in df.columns]
+    return df[[names[k] for k in keys]].rename(
+        columns= {names[k]: new_names[k] for k in keys}
+    )
+
+def stream_to_dataframe(datapoints, stations):
+    
+    # Determine column names
+    col_name = column_names(stations)
     
     def extract_data(d):
         extracted = {
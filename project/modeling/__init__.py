@@ -18,10 +18,13 @@ def add_predictions(datapoints, stations: list):
     Adds predictions to the datapoints from the stations
     models if they exist.
     
-    Note: The datapoints must be sorted by date for
-    this function to work.
+    Note: The datapoints must be in date order (as streamed by
+    get_data) for this function to work. They are read into a list,
+    since the models predict on the whole dataset at once.
     """
     
+    datapoints = list(datapoints)
+    
     station_preds = {}
     
     # Create datastructure to hold stations predictions
@@ -45,7 +48,8 @@ def add_predictions(datapoints, stations: list):
         # Add pred to stations values in datapoint if correct date
         for s, preds in station_preds.items():
             if preds['next'][0] == dp['date']:
-                dp[s]['estimated'] = preds['next'][1]
+                # Copy, since datapoints from the stream may be read-only records
+                dp = {**dp, s: {**dp[s], 'estimated': preds['next'][1]}}
                 try: preds['next'] = next(preds['gen'])
                 # End of iterator -> signal stop adding predictions
                 except StopIteration: preds['next'] = (None, None)
@@ -57,10 +61,7 @@ def add_predictions(datapoints, stations: list):
 if __name__ == "__main__":
     from project.data import reader
     
-    datapoints = sorted(
-        reader().get_data(years= ['2017'], how= 'stream'),
-        key= lambda x: x['date']
-    )
+    datapoints = list(reader.get_data(years= ['2017'], how= 'stream'))
     
     print(type(datapoints))
     
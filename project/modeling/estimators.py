@@ -191,7 +191,7 @@ class PumpdataVectorizer(BaseEstimator, TransformerMixin):
         
         for prev_date in missing_dates[::-1]:
             month_data = self.__get_averages(prev_date.month)
-            datapoint = recent_data.get(prev_date, {})
+            datapoint = dict(recent_data.get(prev_date, {}))  # Records are read-only
 
             if not self.station in datapoint:
                 datapoint[self.station] = {
@@ -311,7 +311,7 @@ if __name__ == "__main__":
     station = 'Gronneviksoren'
     vectorizer = PumpdataVectorizer(station)
     vectorized = vectorizer.transform(
-        sorted([
+        [
             x for x in PickledDataReader().get_data(dt(2010, 4, 1),
                                                     dt(2011, 3, 13),
                                                     how= 'stream')
@@ -320,7 +320,7 @@ if __name__ == "__main__":
             x for x in PickledDataReader().get_data(dt(2011, 4, 6),
                                                     how= 'stream')
             if station in x
-        ], key= lambda x: x['date'])
+        ]
     )
 
     print(vectorized[:10])
\ No newline at end of file
@@ -73,7 +73,8 @@ if __name__ == "__main__":
     ], key= lambda x: x['date'])"""
     
     # For station: GeorgenesVerft
-    dataset = sorted([
+    # The streams are chronological and the periods in order, no need to sort
+    dataset = [
         x for x in reader.get_data(
             dt(2012, 10, 25, 11),
             dt(2012, 11, 30, 11),
@@ -93,7 +94,7 @@ if __name__ == "__main__":
             how= 'stream'
         )
         if station in x
-    ], key= lambda x: x['date'])
+    ]
     
     labels = np.array([x[station]['quantity (l/s)'] for x in dataset])
     
@@ -1,25 +1,144 @@
 import pandas as pd
+import numpy as np
 import re
+from itertools import islice
 from datetime import datetime as dt
+from project.data.rollups import can_serve, finalize, labels, total_partial
+
+# Width in pixels the figures are downsampled for, about a wide screen graph
+PLOT_WIDTH = 1600
+
+def create_figure(df, max_points: int= 2 * PLOT_WIDTH, method: str= 'minmax', window: tuple= None,
+                  uirevision= 'graph'):
+    """
+    Line figure of the columns of df. Each trace is downsampled to about
+    max_points points (see downsample), None sends every point (e.g. for exports).
+
+    window: (start, end) of the x range zoomed to (see visible_range). The points
+    in it are downsampled to max_points on their own, the rest is kept as a
+    coarse overview of max_points // 4, so zooming in shows the full resolution
+    while the size of the figure stays bounded.
+
+    uirevision: the graph keeps its zoom when updated with a figure of the
+    same uirevision, and shows everything when it changes.
+    """
+    x = df.index.to_numpy().astype('datetime64[ns]').astype(np.int64)
+    if window is not None:
+        lo = np.searchsorted(x, pd.Timestamp(window[0]).value, side= 'left')
+        hi = np.searchsorted(x, pd.Timestamp(window[1]).value, side= 'right')
+
+    def trace(col):
+        y = df[col].to_numpy(dtype= float)
+        if max_points is None or len(y) <= max_points:
+            return df.index, df[col]
+        if window is None:
+            idx = downsample(x, y, max_points, method)
+        else:
+            overview = downsample(x, y, max_points // 4, method)
+            idx = np.concatenate([
+                overview[(overview < lo) | (overview >= hi)],
+                lo + downsample(x[lo:hi], y[lo:hi], max_points, method)
+            ])
+            idx.sort()
+        return df.index[idx], df[col].iloc[idx]
 
-def create_figure(df):
     return {
         'data': [
             dict(
-                x= df.index,
-                y= df[col],
+                x= x,
+                y= y,
                 mode= 'lines',
                 name= col,
                 type= 'scatter',
                 opacity= 0.7
-            ) for col in df.columns
+            ) for col in df.columns for x, y in [trace(col)]
         ],
         'layout': {
+            'uirevision': uirevision,
             'transition': {'duration': 500},
             'margin': {'l': 20, 'b': 20, 't': 20, 'r': 10},
             'legend': {'x': 0 , 'yref': 'paper', 'y': 1, 'xref': 'paper', 'bgcolor': 'rgba(0,0,0,0)'}
         }
     }
+
+def visible_range(relayout_data: dict) -> tuple:
+    """
+    (start, end) timestamps of the x range the graph is zoomed to, from its
+    relayoutData, or None if it shows everything (or only the y axis changed).
+    """
+    if not relayout_data or relayout_data.get('xaxis.autorange'): return None
+    if 'xaxis.range[0]' in relayout_data:
+        start, end = relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    elif 'xaxis.range' in relayout_data:
+        start, end = relayout_data['xaxis.range']
+    else:
+        return None
+    return pd.Timestamp(start), pd.Timestamp(end)
+
+def downsample(x: np.ndarray, y: np.ndarray, max_points: int, method: str= 'minmax') -> np.ndarray:
+    """
+    Sorted indices of about max_points points of the line (x, y) that look
+    like the whole line when plotted, x increasing. The points are split into
+    buckets of consecutive points, and from each bucket are kept:
+
+        'minmax': the minimum and the maximum, so spikes are always kept
+        'lttb': the point making the largest triangle with the point kept
+            from the bucket before and the average of the bucket after
+            (largest triangle three buckets), which follows the shape closer.
+            Loops over the buckets, so it is slower than 'minmax'.
+
+    Gaps (nan) at least a bucket long are kept as gaps, by keeping their first point.
+    """
+    n = len(y)
+    if n <= max_points: return np.arange(n)
+
+    buckets = max(max_points // 2 if method == 'minmax' else max_points - 2, 1)
+    if method == 'minmax':
+        edges = np.linspace(0, n, buckets + 1).astype(int)
+        bucket = np.repeat(np.arange(buckets), np.diff(edges))
+        # All nan buckets have inf as both, and keep their first point
+        lo = np.where(np.isnan(y), np.inf, y)
+        hi = np.where(np.isnan(y), -np.inf, y)
+        keep = [
+            first_where(values == reduce.reduceat(values, edges[:-1])[bucket], bucket)
+            for values, reduce in [(lo, np.minimum), (hi, np.maximum)]
+        ]
+    elif method == 'lttb':
+        # The first and last points are kept, the rest split into buckets
+        edges = np.linspace(1, n - 1, buckets + 1).astype(int)
+        x = x.astype(float)
+        keep = [np.array([0, n - 1])]
+        selected = np.empty(buckets, dtype= int)
+        a = int(np.argmax(~np.isnan(y)))  # Last point kept that is not nan
+        for i in range(buckets):
+            start, end = edges[i], edges[i + 1]
+            after = slice(end, edges[i + 2]) if i + 2 <= buckets else slice(n - 1, n)
+            avg_x = x[after].mean()
+            avg_y = np.nanmean(y[after]) if not np.isnan(y[after]).all() else y[a]
+            area = np.abs(
+                (x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a])
+            )
+            if np.isnan(area).all():
+                selected[i] = start
+            else:
+                selected[i] = a = start + np.nanargmax(area)
+        keep.append(selected)
+    else:
+        raise ValueError(f'Unknown downsampling method {method}')
+
+    # First points of the gaps
+    missing = np.concatenate([[False], np.isnan(y), [False]])
+    starts = np.flatnonzero(~missing[:-1] & missing[1:])
+    ends = np.flatnonzero(missing[:-1] & ~missing[1:])
+    keep.append(starts[ends - starts >= n / buckets])
+
+    return np.unique(np.concatenate(keep))
+
+def first_where(mask: np.ndarray, group: np.ndarray) -> np.ndarray:
+    """Index of the first True of mask in each group (sorted group ids) that has one"""
+    hits = np.flatnonzero(mask)
+    _, first = np.unique(group[hits], return_index= True)
+    return hits[first]
     
 """
 'title': {
@@ -42,80 +161,321 @@ def resolve_dates(*args):
 
 def filter_by_hours(df, hour_ints):
     """Filter date indexed df by the hours (ints) in hour_ints"""
-    from datetime import time
-    first, last = tuple(map(time, hour_ints))
-    if first.hour != 0:
-        df = df = df[first <= df.index.map(lambda d: d.time())]
-    if last.hour != 23:
-        df = df[df.index.map(lambda d: d.time()) <= last]
-    return df  # Could also use df.between_time(start_time, end_time), faster?
+    first, last = hour_ints
+    if df.empty or (first == 0 and last == 23): return df
+    dates = df.index.to_numpy()
+    time = dates - dates.astype('datetime64[D]')
+    keep = np.ones(len(df), dtype= bool)
+    if first != 0:
+        keep &= np.timedelta64(first, 'h') <= time
+    if last != 23:
+        keep &= time <= np.timedelta64(last, 'h')
+    return df[keep]
+
+# Groups of each aggregation, as grains of rollups.labels
+AGGREGATION_GRAINS = {
+    'hours': 'day',
+    'days': 'month_hour',
+    'months': 'year_day_hour',
+    'years': 'month_day_hour'
+}
+
+def aggregate(df: pd.DataFrame, aggregations: list) -> pd.DataFrame:
+    """
+    Applies the aggregations, list of (name, method) with name one of
+    AGGREGATION_GRAINS, to the date indexed df in order. Each is one groupby
+    by the labels of its groups, computed from the dates with numpy, which
+    are also the index of the result.
+    """
+    for name, method in aggregations:
+        if df.empty: break
+        groups = labels(df.index.to_numpy(), AGGREGATION_GRAINS[name])
+        df = df.groupby(pd.DatetimeIndex(groups.astype('datetime64[ns]'))).agg(method)
+    return df
 
 def aggregate_hours(df: pd.DataFrame, method: str = 'mean'):
     """Aggregate specified hours by method (mean, max, min or median)"""
-    df = df.groupby(df.index.date).agg({ col: [method] for col in df.columns })
-    df.index = pd.to_datetime(df.index)
-    df.columns = df.columns.droplevel(1)
-    return df
+    return aggregate(df, [('hours', method)])
 
 def aggregate_days(df: pd.DataFrame, method: str = 'mean'):
     """Aggregate days of the month by method, e.g. mean"""
-    df =  df.groupby([pd.Grouper(freq='MS'), df.index.hour]).agg(
-        { col: [method] for col in df.columns}
-    )
-    df.index = df.index.map( lambda m: m[0].replace(hour=m[1]))
-    df.columns = df.columns.droplevel(1)
-    return df
+    return aggregate(df, [('days', method)])
 
 def aggregate_months(df: pd.DataFrame, method: str = 'mean'):
     """Aggregate months of the year by methof, e.g. sum"""
-    df =  df.groupby([pd.Grouper(freq='Y'), df.index.day, df.index.hour]).agg(
-        { col: [method] for col in df.columns}
-    )
-    df.index = df.index.map( lambda m: m[0].replace(day= m[1], hour=m[2]) )
-    df.columns = df.columns.droplevel(1)
-    return df
-
+    return aggregate(df, [('months', method)])
 
 def aggregate_years(df: pd.DataFrame, method: str = 'mean'):
-    from datetime import datetime as dt
     """Aggregate years by method, e.g. max"""
-    df =  df.groupby([df.index.month, df.index.day, df.index.hour]).agg(
-        { col: [method] for col in df.columns}
-    )
-    df.index = df.index.map( lambda m: dt(2016, m[0], m[1], m[2]))  # 2016, beacause this is a leap year
-    df.columns = df.columns.droplevel(1)
-    return df
+    return aggregate(df, [('years', method)])
+
+AGGREGATIONS = {
+    'hours': aggregate_hours,
+    'days': aggregate_days,
+    'months': aggregate_months,
+    'years': aggregate_years
+}
+
+# Groups of the first aggregation that can be merged from the rollups of the data
+ROLLUP_GRAINS = {'hours': 'day', 'days': 'month_hour', 'months': 'year_day_hour'}
+# Methods of the aggregations that can be merged, see rollups.finalize
+ROLLUP_METHODS = ['mean', 'sum', 'min', 'max', 'std']
 
-def filter_wet_days(datapoints, window: list, treshold: float):
+def aggregate_from_rollups(reader, columns: dict, aggregations: list, date1, date2,
+                           years= None, months= None, days= None, weekdays= None, hour_pair= None):
     """
-    Removes datapoints that is considered to be from "rainy" days.
-    What is determined as a rainy day, depends on num_days and value.
+    Same dataframe and statistics as aggregating the hourly dataframe of
+    columns filtered by filter_by_hours, but the first aggregation is merged
+    from the rollups of the data (see PickledDataReader.aggregate), so for it
+    only the hours at the range edges are read. The median of the statistics
+    can't be merged: it is computed from one read of all the hourly values of
+    the range, so this only pays off where that read is cheap (the columnar
+    backend). Neither can a median aggregation, which is not served here.
+
+    Args:
+        reader: PickledDataReader of the data
+        columns: dict of station -> measurements (the columns, named as by stream_to_dataframe)
+        aggregations: list of (name, method) applied in order, name one of AGGREGATIONS
+
+    Returns (dataframe, statistics), or None if the first aggregation
+    can't be merged from the rollups with these filters or its method.
+    """
+    name, method = aggregations[0]
+    grain = ROLLUP_GRAINS.get(name)
+    hours = tuple(hour_pair) if hour_pair is not None else None
+    if grain is None or method not in ROLLUP_METHODS or not can_serve(grain, months, days, weekdays, hours):
+        return None
+
+    all_meas = [m for meas in columns.values() for m in meas]
+    aggregated, totals = {}, {}
+    for station, meas in columns.items():
+        for m in meas:
+            part = reader.aggregate(station, m, grain, date1, date2, years, months,
+                                    days, weekdays, hours)
+            if part is None: continue
+            col = f'{m} ({station})' if all_meas.count(m) > 1 else m
+            aggregated[col] = pd.Series(
+                finalize(part, method), index= pd.DatetimeIndex(part['label'].astype('datetime64[ns]'))
+            )
+            totals[col] = total_partial(part)
+
+    # Groups other columns have are 0 for sum, like pandas sums no values
+    df = pd.DataFrame(aggregated)
+    if method == 'sum': df = df.fillna(0)
+
+    # One read of the hourly values for all columns
+    values = reader.get_values(columns, date1, date2, years, months, days, weekdays, hours) if totals else {}
+    stats = {}
+    for station, meas in columns.items():
+        for m in meas:
+            col = f'{m} ({station})' if all_meas.count(m) > 1 else m
+            if col not in totals: continue
+            total = totals[col]
+            stats[col] = [
+                finalize(total, 'mean')[0], finalize(total, 'max')[0], finalize(total, 'min')[0],
+                np.nanmedian(values[station, m][1]),
+                finalize(total, 'sum')[0], finalize(total, 'std')[0]
+            ]
+    stats = pd.DataFrame(stats, index= ['mean', 'max', 'min', 'median', 'sum', 'std'])
+
+    return aggregate(df, aggregations[1:]), stats
+
+# Stations the precipitation of the dry weather filter is taken from, in order of preference
+PRECIPITATION_STATIONS = ['florida_sentrum', 'florida_uib']
+
+class DryWeatherFilter(object):
+    """
+    Decides which hours are dry: those where the precipitation summed over a
+    window of preceding hours is below treshold. Each call to mask continues
+    from the hours of the previous, so long series can be filtered in chunks.
+    The window sums are differences of cumulative sums, so filtering n hours
+    takes O(n) whatever the window.
+
+    Args:
+        window: [first, last] of the precipitation RangeSlider. Summed are the
+        hours from 100 - first hours before the hour, inclusive, up to
+        100 - last hours before it, exclusive. Hours before the first are 0.
+
+        treshold: max summed precipitation of a dry hour. Hours with a
+        missing (nan) value in their window are not dry.
+    """
+    def __init__(self, window: list, treshold: float):
+        self.num_hours = 100 - window[0]
+        self.lag = 100 - window[1]
+        self.treshold = treshold
+        self.previous = np.zeros(self.num_hours)  # The last num_hours values
+
+    def mask(self, precipitation) -> np.ndarray:
+        """Boolean array telling which of the next hours (their precipitation in order) are dry"""
+        values = np.concatenate([self.previous, np.asarray(precipitation, dtype= float)])
+        missing = np.isnan(values)
+        sums = np.concatenate([[0], np.cumsum(np.where(missing, 0, values))])
+        nans = np.concatenate([[0], np.cumsum(missing)])
+
+        # Window [lo, hi) of each new value at index i
+        i = np.arange(self.num_hours, len(values))
+        lo, hi = i - self.num_hours + 1, np.maximum(i - self.lag + 1, i - self.num_hours + 1)
+        window_sums = sums[hi] - sums[lo]
+        complete = nans[hi] == nans[lo]
+        dry = complete & (window_sums < self.treshold)
+
+        # Sums within rounding error of treshold are summed again in order,
+        # so the result is exactly that of summing the window
+        tolerance = 4 * np.finfo(float).eps * len(values) * (1 + np.abs(sums[-1]))
+        for k in np.flatnonzero(complete & (np.abs(window_sums - self.treshold) <= tolerance)):
+            dry[k] = sum(values[lo[k]:hi[k]].tolist()) < self.treshold
+
+        self.previous = values[len(values) - self.num_hours:]
+        return dry
+
+def datapoint_precipitation(dp) -> float:
+    """Precipitation of the datapoint, from the first of PRECIPITATION_STATIONS it has (0 if none)"""
+    for station in PRECIPITATION_STATIONS:
+        if station in dp: return dp[station]['precipitation (mm)']
+    return 0
+
+def block_precipitation(block) -> np.ndarray:
+    """Same as datapoint_precipitation, for all rows of a records.Block"""
+    precipitation = np.zeros(len(block))
+    for station in reversed(PRECIPITATION_STATIONS):
+        if station in block.present:
+            present = block.present[station]
+            precipitation[present] = block.columns[station]['precipitation (mm)'][present]
+    return precipitation
+
+def filter_wet_days(datapoints, window: list, treshold: float, chunk_size: int= 4096):
+    """
+    Removes datapoints that is considered to be from "rainy" days, see
+    DryWeatherFilter. The precipitation of a datapoint is that of
+    datapoint_precipitation. The datapoints are filtered lazily, chunk_size at a time.
     
     Args
-        dict_of_dfs: result from reader.get_data, i.e. dfs containing data from all
-        stations
-        num_days: # of preceding days to concider when summing precipitation
-        values including current day
+        datapoints: datapoints in chronological order, e.g. reader.get_data(how= 'stream')
+        window: value of the RangeSlider, see DryWeatherFilter
         treshold: max treshold value for the summed precipitation level
     """
-    num_hours = 100 - window[0]
-    current_values = [0] * num_hours # to store precipitation vals
-    lag = 100 - window[1]
-    
-    def check_and_update(value):
-        # FIFO - keeps length the same
-        current_values.pop(0)
-        current_values.append(value)
-        # In case lag is 0 -> must use len
-        return sum(current_values[:len(current_values) - lag]) < treshold
-    
-    for dp in datapoints:
-        if 'florida_sentrum' in dp:
-            val = dp['florida_sentrum']['precipitation (mm)']
-        elif 'florida_uib' in dp:
-            val = dp['florida_uib']['precipitation (mm)']
+    dry = DryWeatherFilter(window, treshold)
+    datapoints = iter(datapoints)
+    while True:
+        chunk = list(islice(datapoints, chunk_size))
+        if not chunk: return
+        mask = dry.mask([datapoint_precipitation(dp) for dp in chunk])
+        yield from (dp for dp, keep in zip(chunk, mask) if keep)
+
+def filter_wet_blocks(blocks, window: list, treshold: float):
+    """Same as filter_wet_days, for records.Block streams (get_data(how= 'blocks'))"""
+    dry = DryWeatherFilter(window, treshold)
+    for block in blocks:
+        mask = dry.mask(block_precipitation(block))
+        if mask.any(): yield block.take(mask)
+
+def filter_wet_rows(df: pd.DataFrame, precipitation, window: list, treshold: float) -> pd.DataFrame:
+    """
+    Same as filter_wet_days, for the rows of a date ordered dataframe,
+    with precipitation the precipitation of each row
+    """
+    return df[DryWeatherFilter(window, treshold).mask(precipitation)]
+
+# Check the aggregations and the dry weather filter against the code they
+# replaced, and compare their speed on 10 years of hourly data
+if __name__ == '__main__':
+    import time
+    from datetime import time as tm
+    from project.data.reader import PickledDataReader
+
+    def reference_filter_by_hours(df, hour_ints):
+        first, last = tuple(map(tm, hour_ints))
+        if first.hour != 0:
+            df = df[first <= df.index.map(lambda d: d.time())]
+        if last.hour != 23:
+            df = df[df.index.map(lambda d: d.time()) <= last]
+        return df
+
+    def reference_aggregate(df, name, method):
+        if name == 'hours':
+            df = df.groupby(df.index.date).agg({col: [method] for col in df.columns})
+            df.index = pd.to_datetime(df.index)
+        elif name == 'days':
+            df = df.groupby([pd.Grouper(freq= 'MS'), df.index.hour]).agg({col: [method] for col in df.columns})
+            df.index = df.index.map(lambda m: m[0].replace(hour= m[1]))
+        elif name == 'months':
+            df = df.groupby([pd.Grouper(freq= 'Y'), df.index.day, df.index.hour]).agg({col: [method] for col in df.columns})
+            df.index = df.index.map(lambda m: m[0].replace(day= m[1], hour= m[2]))
         else:
-            val = 0 # whats the deffault?
-            #print(f'no precipitation data for datapoint from {dp["date"]}')
-        if check_and_update(val):
-            yield dp
\ No newline at end of file
+            df = df.groupby([df.index.month, df.index.day, df.index.hour]).agg({col: [method] for col in df.columns})
+            df.index = df.index.map(lambda m: dt(2016, m[0], m[1], m[2]))
+        df.columns = df.columns.droplevel(1)
+        return df
+
+    def reference_filter_wet_days(datapoints, window, treshold):
+        num_hours = 100 - window[0]
+        current_values = [0] * num_hours
+        lag = 100 - window[1]
+        for dp in datapoints:
+            current_values.pop(0)
+            current_values.append(datapoint_precipitation(dp))
+            if sum(current_values[:len(current_values) - lag]) < treshold:
+                yield dp
+
+    # Ten years of hours with missing values and a missing month, and the data of a pump station
+    rng = np.random.default_rng(0)
+    index = pd.date_range('2010-01-01', '2019-12-31 23:00', freq= 'h', name= 'date')
+    index = index[(index < '2013-04-01') | (index >= '2013-05-01')]
+    synthetic = pd.DataFrame(rng.gamma(2, 10, (len(index), 3)), index= index, columns= ['a', 'b', 'c'])
+    synthetic[rng.random(synthetic.shape) < 0.05] = np.nan
+    reader = PickledDataReader(backend= 'columnar')
+    station = reader.get_data(reader.get_earliest_date(), reader.get_latest_date(),
+                              stations= ['WolffsGate'])['WolffsGate']
+
+    sequences = [
+        [('hours', 'mean')], [('days', 'max')], [('months', 'sum')], [('years', 'median')],
+        [('hours', 'std'), ('months', 'mean')], [('hours', 'sum'), ('days', 'min'), ('years', 'max')]
+    ]
+    for label, df in [('synthetic', synthetic), ('WolffsGate', station)]:
+        for hour_pair in [(0, 23), (6, 18)]:
+            start = time.perf_counter()
+            expected = reference_filter_by_hours(df, hour_pair)
+            reference_time = time.perf_counter() - start
+            start = time.perf_counter()
+            result = filter_by_hours(df, hour_pair)
+            print(f'{label} ({len(df)} rows) filter_by_hours{hour_pair}: '
+                  f'{reference_time:.3f} s -> {time.perf_counter() - start:.4f} s')
+            pd.testing.assert_frame_equal(result, expected)
+
+        for aggregations in sequences:
+            start = time.perf_counter()
+            expected = df
+            for name, method in aggregations:
+                expected = reference_aggregate(expected, name, method)
+            reference_time = time.perf_counter() - start
+            start = time.perf_counter()
+            result = aggregate(df, aggregations)
+            print(f'{label} ({len(df)} rows) {aggregations}: '
+                  f'{reference_time:.3f} s -> {time.perf_counter() - start:.4f} s')
+            pd.testing.assert_frame_equal(result, expected, check_freq= False)
+
+    # The filter counts its window in datapoints, so it is checked on the
+    # stream of all stations, as the app reads it. A projected stream lacks
+    # the hours where only other stations have data, and keeps other hours
+    date1, date2 = reader.get_earliest_date(), reader.get_latest_date()
+    stream = list(reader.get_data(date1, date2, how= 'stream'))
+    projected = list(reader.get_data(date1, date2, how= 'stream', stations= ['WolffsGate', 'florida_uib']))
+    for window, treshold in [([28, 100], 5), ([0, 100], 5), ([28, 90], 0.5), ([50, 50], 1), ([0, 76], 20), ([0, 90], 1)]:
+        start = time.perf_counter()
+        expected = [dp['date'] for dp in reference_filter_wet_days(stream, window, treshold)]
+        reference_time = time.perf_counter() - start
+        start = time.perf_counter()
+        result = [dp['date'] for dp in filter_wet_days(stream, window, treshold)]
+        stream_time = time.perf_counter() - start
+        start = time.perf_counter()
+        blocks = list(filter_wet_blocks(reader.get_data(date1, date2, how= 'blocks'), window, treshold))
+        block_time = time.perf_counter() - start
+        shown = set(dp['date'] for dp in projected)
+        differs = [dp['date'] for dp in filter_wet_days(projected, window, treshold)] != \
+            [date for date in expected if date in shown]
+        print(f'filter_wet_days({window}, {treshold}) of {len(stream)} datapoints: {reference_time:.3f} s '
+              f'-> {stream_time:.3f} s, blocks (incl. reading) {block_time:.3f} s, {len(result)} kept'
+              f'{", differs when projected" if differs else ""}')
+        assert result == expected
+        assert [d for block in blocks for d in block.datetimes] == expected
+    print('equal')